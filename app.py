@@ -16,17 +16,36 @@ Author: SchoolSync Team
 Last Updated: 2026-02-13
 """
 
-from flask import Flask
-from config import config, validate_production_config, validate_development_config, get_config_info
-from extensions import db, csrf, limiter, cache, migrate, mail, login_manager
+from flask import Flask, session
+from flask.logging import default_handler
+from config import config, validate_config, get_config_info
+from extensions import (
+    db, csrf, limiter, cache, login_manager, init_migrate, init_json, init_sqlite,
+    get_redis
+)
+from models import User, get_cached_user, get_internal_user
+from routes import main
+from auth import auth
 import os
+import hmac
 import logging
 import sys
-from dotenv import load_dotenv
+import atexit
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import click
 from werkzeug.middleware.proxy_fix import ProxyFix
+from itsdangerous import URLSafeTimedSerializer
 
-# Load environment variables first
-load_dotenv()
+# CLI commands that need nothing but the database
+DB_ONLY_COMMANDS = {'cleanup-tokens', 'show-config', 'seed-data'}
+
+
+def _is_db_only_command():
+    """Return True when the flask CLI is loading the app for a DB_ONLY_COMMANDS command."""
+    if click.get_current_context(silent=True) is None:
+        return False
+    return any(arg in DB_ONLY_COMMANDS for arg in sys.argv[1:])
 
 
 # ============================================
@@ -48,6 +67,16 @@ def create_app(config_name=None):
     """
     app = Flask(__name__, static_folder='static', static_url_path='/static')
     
+    # ============================================
+    # PROXY CONFIGURATION
+    # ============================================
+    
+    # Render (and most cloud providers) use reverse proxies.
+    # ProxyFix ensures Flask correctly identifies the actual client IP
+    # by looking at the X-Forwarded-For header. Applied first so every
+    # extension set up below only ever sees the corrected environ.
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_port=1, x_prefix=1)
+    
     # ============================================
     # LOAD CONFIGURATION
     # ============================================
@@ -57,42 +86,70 @@ def create_app(config_name=None):
     
     app.config.from_object(config[config_name])
     
+    if not app.config.get('TESTING'):
+        validate_config()
+    
+    # Password reset tokens: one shared serializer instead of one per request
+    app.extensions['reset_serializer'] = URLSafeTimedSerializer(
+        app.config['SECRET_KEY'], salt='password-reset-salt'
+    )
+    
     # ============================================
     # INITIALIZE EXTENSIONS
     # ============================================
     
     # Database
     db.init_app(app)
+    init_sqlite(app)
     
-    # CSRF Protection
-    csrf.init_app(app)
-    
-    # Email
-    mail.init_app(app)
-    
-    # Rate Limiter
-    try:
-        limiter.init_app(app)
-        limiter.storage_uri = app.config.get('RATELIMIT_STORAGE_URL', 'memory://')
+    # Commands that only touch the database (see DB_ONLY_COMMANDS) skip
+    # the request-serving extensions: CSRF, sessions, rate limiter, cache
+    if not _is_db_only_command():
+        # CSRF Protection
+        csrf.init_app(app)
+        
+        # JSON responses: orjson when installed
+        init_json(app)
+        
+        # Server-side sessions (only when Redis is configured, see config.py)
+        if app.config.get('SESSION_TYPE') == 'redis':
+            from flask_session import Session
+            with app.app_context():
+                app.config['SESSION_REDIS'] = get_redis()
+            Session(app)
+        
+        # Email: Flask-Mail is bound on first send (extensions.get_mail)
         
-        # Override default limits if specified in config
-        if app.config.get('RATELIMIT_DEFAULT'):
-            limits = app.config.get('RATELIMIT_DEFAULT').split(';')
-            limiter.default_limits = [limit.strip() for limit in limits]
+        # Rate Limiter
+        try:
+            # Default limits are parsed by Flask-Limiter from RATELIMIT_DEFAULT
+            limiter.init_app(app)
             
-        app.logger.info(f"Rate limiter initialized with {limiter.storage_uri}")
-    except Exception as e:
-        app.logger.warning(f"Rate limiter initialization failed: {e}")
-    
-    # Cache
-    try:
-        cache.init_app(app, config={'CACHE_TYPE': 'SimpleCache'})
-        app.logger.info("Cache initialized")
-    except Exception as e:
-        app.logger.warning(f"Cache initialization failed: {e}")
+            storage_uri = app.config.get('RATELIMIT_STORAGE_URI', 'memory://')
+            if storage_uri.startswith('memory://') and config_name != 'development':
+                app.logger.warning(
+                    "Rate limiter is using in-memory storage; limits are not shared "
+                    "between workers. Set RATELIMIT_STORAGE_URL or REDIS_URL."
+                )
+            
+            app.logger.info(
+                f"Rate limiter initialized with {storage_uri.split('://', 1)[0]} storage "
+                f"({app.config.get('RATELIMIT_STRATEGY')})"
+            )
+        except Exception as e:
+            app.logger.warning(f"Rate limiter initialization failed: {e}")
+        
+        # Cache
+        try:
+            cache.init_app(app)
+            app.logger.info(f"Cache initialized ({app.config.get('CACHE_TYPE')})")
+        except Exception as e:
+            app.logger.warning(f"Cache initialization failed: {e}")
     
-    # Database Migrations
-    migrate.init_app(app, db)
+    # Database Migrations: only the `flask db` commands need Flask-Migrate,
+    # so skip importing it when serving requests
+    if click.get_current_context(silent=True) is not None:
+        init_migrate(app)
     
     # ============================================
     # FLASK-LOGIN CONFIGURATION
@@ -102,32 +159,43 @@ def create_app(config_name=None):
     login_manager.login_view = 'auth.login'
     login_manager.login_message = 'Please log in to access this page.'
     login_manager.login_message_category = 'info'
+    # 'basic' only marks a mismatched session non-fresh (no forced reload)
+    login_manager.session_protection = 'basic'
     
     @login_manager.user_loader
     def load_user(user_id):
         """
         Load user by ID for Flask-Login.
+        
+        Flask-Login keeps the result on flask.g for the rest of the
+        request; across requests the row is served from the user cache.
         """
-        from models import User
         try:
-            return db.session.get(User, int(user_id))
+            user = get_cached_user(user_id)
         except (ValueError, TypeError):
-            return None
+            user = None
+        if user is None:
+            # Stale session (user deleted): drop it so the cookie-only
+            # "already logged in" checks in auth don't redirect-loop
+            session.pop('_user_id', None)
+        return user
 
+    # Shared secret for the Node.js service, read once per app
+    internal_secret = (os.environ.get('INTERNAL_SECRET_KEY') or '').encode()
+    
     @login_manager.request_loader
     def request_loader(request):
         """
         Allows Node.js app to authenticate via X-Internal-Secret header.
         """
-        secret = os.environ.get('INTERNAL_SECRET_KEY')
-        if not secret:
+        if not internal_secret:
             return None
             
-        auth_header = request.headers.get('X-Internal-Secret')
-        if auth_header == secret:
-            from models import User
-            # Return the first super_admin as the acting user
-            return User.query.filter_by(role='super_admin').first()
+        auth_header = request.headers.get('X-Internal-Secret', '').encode()
+        # Constant-time comparison so response timing does not leak the secret
+        if hmac.compare_digest(auth_header, internal_secret):
+            # Act as a super_admin (cached, so no query per internal call)
+            return get_internal_user()
         return None
     
     # ============================================
@@ -135,12 +203,10 @@ def create_app(config_name=None):
     # ============================================
     
     # Only works locally (Vercel has read-only filesystem)
-    if not os.path.exists(app.config['UPLOAD_FOLDER']):
-        try:
-            os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-            app.logger.info(f"Created upload folder: {app.config['UPLOAD_FOLDER']}")
-        except OSError as e:
-            app.logger.warning(f"Could not create upload folder (read-only filesystem): {e}")
+    try:
+        os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    except OSError as e:
+        app.logger.warning(f"Could not create upload folder (read-only filesystem): {e}")
     
     # ============================================
     # SETUP LOGGING
@@ -152,9 +218,6 @@ def create_app(config_name=None):
     # REGISTER BLUEPRINTS
     # ============================================
     
-    from routes import main
-    from auth import auth
-    
     app.register_blueprint(main)
     app.register_blueprint(auth)
     
@@ -164,7 +227,9 @@ def create_app(config_name=None):
     # REGISTER CLI COMMANDS
     # ============================================
     
-    register_cli_commands(app)
+    # Only the flask CLI runs these; WSGI workers skip defining them
+    if click.get_current_context(silent=True) is not None:
+        register_cli_commands(app)
     
     # ============================================
     # LOG CONFIGURATION INFO
@@ -176,15 +241,6 @@ def create_app(config_name=None):
         for key, value in config_info.items():
             app.logger.info(f"  {key}: {value}")
     
-    # ============================================
-    # PROXY CONFIGURATION
-    # ============================================
-    
-    # Render (and most cloud providers) use reverse proxies.
-    # ProxyFix ensures Flask correctly identifies the actual client IP
-    # by looking at the X-Forwarded-For header.
-    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_port=1, x_prefix=1)
-    
     return app
 
 
@@ -196,20 +252,41 @@ def setup_logging(app):
     """
     Setup application logging (compatible with serverless platforms).
     
-    Logs to stdout for cloud platforms like Render and Vercel.
+    Logs to stdout for cloud platforms like Render and Vercel. Request
+    threads only enqueue records; a QueueListener thread does the actual
+    write, so a slow or blocked stdout pipe never stalls a request.
     
     Args:
         app: Flask application instance
     """
     if not app.debug and not app.testing:
+        # app.logger is a process-wide logger shared by every app instance:
+        # only the first create_app() call attaches the queue handler
+        if any(isinstance(h, QueueHandler) for h in app.logger.handlers):
+            return
+        
         # Configure console logging
         handler = logging.StreamHandler(sys.stdout)
         handler.setFormatter(logging.Formatter(
             '[%(asctime)s] %(levelname)s in %(module)s: %(message)s'
         ))
         handler.setLevel(logging.INFO)
-        app.logger.addHandler(handler)
-        app.logger.setLevel(logging.INFO)
+        
+        log_queue = queue.Queue(-1)
+        listener = QueueListener(log_queue, handler, respect_handler_level=True)
+        listener.start()
+        atexit.register(listener.stop)  # Flush queued records on shutdown
+        
+        # Replace Flask's default stderr handler (and stop records reaching
+        # any root handlers) so each record is formatted and written once.
+        # face_handler logs through its own module logger, since it also
+        # runs outside an app context (worker warm-up, decode threads).
+        app.logger.removeHandler(default_handler)
+        queue_handler = QueueHandler(log_queue)
+        for logger in (app.logger, logging.getLogger('face_handler')):
+            logger.addHandler(queue_handler)
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
         app.logger.info('SchoolSync Pro startup')
 
 
@@ -231,21 +308,25 @@ def register_cli_commands(app):
     """
     
     @app.cli.command()
-    def init_db():
+    @click.option('--fast', is_flag=True, envvar='SCHOOLSYNC_FAST_HASH',
+                  help='Hash the default password with a low work factor (CI/tests only).')
+    def init_db(fast):
         """
         Initialize the database and create default admin user.
         
         Creates all tables and adds a default admin account.
         Safe to run multiple times (won't create duplicates).
         """
-        from models import User
+        from models import User, FAST_PASSWORD_HASH_METHOD
         
         print("Creating database tables...")
         db.create_all()
         print("[OK] Database tables created")
         
         # Check if default admin exists
-        admin = User.query.filter_by(username='admin').first()
+        admin = db.session.execute(
+            db.select(User).where(db.func.lower(User.username) == 'admin')
+        ).scalar_one_or_none()
         
         if admin is None:
             # Create default admin
@@ -256,7 +337,10 @@ def register_cli_commands(app):
                 role='super_admin',
                 is_active=True
             )
-            admin_user.set_password('Admin@123')
+            admin_user.set_password(
+                'Admin@123',
+                method=FAST_PASSWORD_HASH_METHOD if fast else None
+            )
             
             db.session.add(admin_user)
             db.session.commit()
@@ -277,29 +361,37 @@ def register_cli_commands(app):
         """
         import getpass
         from models import User
+        from validators import validate_email, validate_username
+        
+        def taken(column, value):
+            """True if a user already has value in column (case-insensitive)."""
+            return db.session.scalar(
+                db.select(db.exists().where(db.func.lower(column) == value.lower()))
+            )
         
         print("\n=== Create New Admin User ===\n")
         
         # Get username
         while True:
             username = input("Username: ").strip()
-            if User.query.filter_by(username=username).first():
-                print("❌ Username already exists. Try another.")
+            is_valid, error = validate_username(username)
+            if not is_valid:
+                print(f"❌ {error}.")
                 continue
-            if len(username) < 3:
-                print("❌ Username must be at least 3 characters.")
+            if taken(User.username, username):
+                print("❌ Username already exists. Try another.")
                 continue
             break
         
         # Get email
         while True:
             email = input("Email: ").strip()
-            if User.query.filter_by(email=email).first():
-                print("❌ Email already in use. Try another.")
-                continue
-            if '@' not in email:
+            if not validate_email(email):
                 print("❌ Invalid email format.")
                 continue
+            if taken(User.email, email):
+                print("❌ Email already in use. Try another.")
+                continue
             break
         
         # Get full name
@@ -357,9 +449,14 @@ def register_cli_commands(app):
         
         cutoff = datetime.utcnow() - timedelta(hours=24)
         
-        deleted = UsedPasswordResetToken.query.filter(
-            UsedPasswordResetToken.used_at < cutoff
-        ).delete()
+        # Plain server-side DELETE (range scan on the used_at index);
+        # no need to match the rows against the empty session first
+        deleted = db.session.execute(
+            db.delete(UsedPasswordResetToken).where(
+                UsedPasswordResetToken.used_at < cutoff
+            ),
+            execution_options={'synchronize_session': False}
+        ).rowcount
         
         db.session.commit()
         
@@ -389,23 +486,20 @@ def register_cli_commands(app):
         
         print("\n=== Seeding Reference Data ===\n")
         
-        # Seed Programs
-        print("Checking Programs...")
-        added_programs = 0
-        for p_name in VALID_PROGRAMS:
-            if not Program.query.filter_by(name=p_name).first():
-                db.session.add(Program(name=p_name))
-                print(f"  + Added: {p_name}")
-                added_programs += 1
-        
-        # Seed Halls
-        print("Checking Halls...")
-        added_halls = 0
-        for h_name in VALID_HALLS:
-            if not Hall.query.filter_by(name=h_name).first():
-                db.session.add(Hall(name=h_name))
-                print(f"  + Added: {h_name}")
-                added_halls += 1
+        def seed(model, names, label):
+            """Add the missing names (one SELECT, one batched INSERT)."""
+            print(f"Checking {label}...")
+            existing = set(db.session.scalars(
+                db.select(model.name).where(model.name.in_(names))
+            ))
+            missing = [name for name in names if name not in existing]
+            db.session.add_all([model(name=name) for name in missing])
+            for name in missing:
+                print(f"  + Added: {name}")
+            return len(missing)
+        
+        added_programs = seed(Program, VALID_PROGRAMS, 'Programs')
+        added_halls = seed(Hall, VALID_HALLS, 'Halls')
                 
         if added_programs or added_halls:
             db.session.commit()
@@ -4,11 +4,10 @@ Authentication Module for SchoolSync Pro
 Table of Contents
 -----------------
 1.  Imports & Setup
-2.  Session Management
-3.  Login & 2FA Logic
-4.  Logout
-5.  Registration (Disabled)
-6.  Password Reset Flow
+2.  Login & 2FA Logic
+3.  Logout
+4.  Registration (Disabled)
+5.  Password Reset Flow
 
 Handles user authentication, 2FA, password reset, and security logging.
 
@@ -21,36 +20,188 @@ from flask import (
     flash, jsonify, session, current_app
 )
 from flask_login import login_user, logout_user, login_required, current_user
-from extensions import db, limiter
-from models import User, UsedPasswordResetToken
+from extensions import db, limiter, get_redis
+from models import (
+    User, UsedPasswordResetToken, get_cached_user, get_user_by_username,
+    get_user_by_email, invalidate_user_cache
+)
 from datetime import datetime, timedelta
-from itsdangerous import URLSafeTimedSerializer, SignatureExpired, BadSignature
+import hashlib
+import hmac
+import time
+from threading import Lock
+from cachetools import TTLCache
+from itsdangerous import SignatureExpired, BadSignature
+from sqlalchemy import update
 import re
 
 # Import utilities
-from utils import generate_otp, send_email_otp, send_password_reset_email, verify_totp
+from utils import (
+    generate_otp, send_email_otp, send_sms_otp, send_password_reset_email,
+    verify_totp, record_last_login
+)
 from security_logger import (
     log_successful_login, log_failed_login, log_logout,
     log_password_change, get_client_ip
 )
 import security_logger as sec_log
+from rate_limiting import preborrowed_limit, FailureLimit
 
 # Create Blueprint
 auth = Blueprint('auth', __name__)
 
+# Email/SMS one-time codes are valid for 10 minutes
+_OTP_TTL = timedelta(minutes=10)
+# Redis compare-and-delete of a user's pending code: only the code that
+# is still current can be consumed, and only once
+_CONSUME_OTP_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+# All codes (email, SMS, TOTP) are exactly six digits
+_OTP_RE = re.compile(r'\A\d{6}\Z')
+# Wrong passwords per username+IP; keyed on both so a guesser elsewhere
+# cannot lock a real user out of their own account
+_login_failures = FailureLimit("5 per 15 minutes", "login-failures")
+
+# Seconds a known-wrong password is remembered (skips the password KDF)
+_BAD_PASSWORD_TTL = 60
+# Fallback store when Redis is not configured
+_bad_passwords = TTLCache(maxsize=10000, ttl=_BAD_PASSWORD_TTL)
+_bad_passwords_lock = Lock()
 
-# ============================================
-# SESSION MANAGEMENT
-# ============================================
 
-@auth.before_request
-def make_session_permanent():
+def _store_otp(user_id, otp_code):
     """
-    Make all sessions permanent with configured timeout.
+    Record a freshly issued email/SMS code as pending for a user.
     
-    Sessions will expire after PERMANENT_SESSION_LIFETIME (default: 1 hour).
+    Each user has a single pending code, so a newer login replaces the
+    previous one. With Redis this is one SETEX of the code's digest
+    (key expires with the code); otherwise a single Core UPDATE of the
+    user's otp columns. Either way it finishes before any email/SMS I/O
+    starts.
+    
+    Returns:
+        str: Keyed digest of the code, for the pending-2FA session state
     """
-    session.permanent = True
+    digest = _otp_digest(otp_code)
+    client = get_redis()
+    if client is not None:
+        client.setex(f"otp:{user_id}", int(_OTP_TTL.total_seconds()), digest)
+        return digest
+    
+    db.session.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(otp_code=otp_code, otp_expiry=datetime.utcnow() + _OTP_TTL)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    invalidate_user_cache(user_id)
+    return digest
+
+
+def _consume_otp(user_id, otp_code):
+    """
+    Use up a pending code so it cannot be redeemed twice.
+    
+    Only the first request to redeem the current code succeeds (a Redis
+    compare-and-delete, or a conditional UPDATE that matched the row),
+    even if a copy of the 2FA session cookie is replayed. A code that a
+    newer login has replaced is refused.
+    
+    Returns:
+        bool: True if the code was still pending and is now consumed
+    """
+    client = get_redis()
+    if client is not None:
+        key = f"otp:{user_id}"
+        return client.eval(_CONSUME_OTP_SCRIPT, 1, key, _otp_digest(otp_code)) == 1
+    
+    result = db.session.execute(
+        update(User)
+        .where(User.id == user_id, User.otp_code == otp_code)
+        .values(otp_code=None, otp_expiry=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    invalidate_user_cache(user_id)
+    return result.rowcount == 1
+
+
+def _check_password(user, password):
+    """
+    Verify a password, skipping the hash check for recently seen wrong ones.
+    
+    Only failures are remembered, for _BAD_PASSWORD_TTL seconds, under
+    an HMAC of the user ID, current password hash and attempted password.
+    Credential-stuffing retries then cost a cache lookup instead of a
+    full Argon2 run. Successes are never cached, and changing the
+    password changes every key, so a cached entry can only ever reject
+    a password that is actually wrong.
+    
+    Args:
+        user (User): User being logged in
+        password (str): Submitted password
+        
+    Returns:
+        bool: True if the password matches
+    """
+    key = hmac.new(
+        current_app.config['SECRET_KEY'].encode(),
+        f"{user.id}:{user.password_hash}:{password}".encode(),
+        hashlib.sha256
+    ).hexdigest()
+    client = get_redis()
+    
+    if client is not None:
+        if client.exists(f"badpw:{key}"):
+            return False
+    else:
+        with _bad_passwords_lock:
+            if key in _bad_passwords:
+                return False
+    
+    old_hash = user.password_hash
+    if user.check_password(password):
+        if user.password_hash != old_hash:
+            # Legacy hash was upgraded to Argon2id; store it
+            db.session.commit()
+            invalidate_user_cache(user.id)
+        return True
+    
+    if client is not None:
+        client.setex(f"badpw:{key}", _BAD_PASSWORD_TTL, 1)
+    else:
+        with _bad_passwords_lock:
+            _bad_passwords[key] = True
+    return False
+
+
+def _otp_digest(otp_code):
+    """
+    Keyed digest of an OTP for the pending-2FA session state.
+    
+    The session cookie is signed but readable, so a bare hash of a
+    6-digit code could be reversed offline; keying it with SECRET_KEY
+    prevents that.
+    """
+    key = current_app.config['SECRET_KEY'].encode()
+    return hmac.new(key, otp_code.encode(), hashlib.sha256).hexdigest()
+
+
+def _already_logged_in():
+    """
+    Return True if the request belongs to a logged-in user.
+    
+    Checks the session for Flask-Login's user ID first, so logged-in
+    users are redirected away from the auth pages without the user
+    loader running. current_user is only consulted (and only hits the
+    database) when a remember-me cookie has to be honoured.
+    """
+    return session.get('_user_id') is not None or current_user.is_authenticated
 
 
 # ============================================
@@ -58,7 +209,8 @@ def make_session_permanent():
 # ============================================
 
 @auth.route('/login', methods=['GET', 'POST'])
-@limiter.limit("10 per minute")  # Rate limit: max 10 login attempts per minute
+@limiter.exempt  # Enforced by preborrowed_limit below (fewer storage round-trips)
+@preborrowed_limit("10 per minute")  # Rate limit: max 10 login attempts per minute
 def login():
     """
     User login endpoint with 2FA support.
@@ -69,7 +221,7 @@ def login():
     - TOTP (Google Authenticator) 2FA
     - Security logging
     """
-    if current_user.is_authenticated:
+    if _already_logged_in():
         return redirect(url_for('main.index'))
     
     if request.method == 'POST':
@@ -77,12 +229,26 @@ def login():
         username = data.get('username', '').strip()
         password = data.get('password', '')
         remember = data.get('remember') == 'on' or data.get('remember') is True
+        failure_key = f"{username.lower()}|{get_client_ip()}"
         
-        # Find user
-        user = User.query.filter_by(username=username).first()
+        # Failed attempts re-render the form with the error passed straight
+        # to the template: flashing it would write to the session (and
+        # re-sign the cookie) only for the message to be popped again in
+        # this same response
+        if _login_failures.exceeded(failure_key):
+            log_failed_login(username, 'Too many failed attempts')
+            if request.is_json:
+                return jsonify({'success': False, 'error': 'Too many failed attempts'}), 429
+            return render_template(
+                'login.html',
+                error='Too many failed login attempts. Please try again in 15 minutes.'
+            ), 429
+        
+        # Find user (repeat logins are served from the user cache)
+        user = get_user_by_username(username)
         
         # Verify password
-        if user and user.check_password(password):
+        if user and _check_password(user, password):
             # Check if account is active
             if not user.is_active:
                 log_failed_login(username, 'Account disabled')
@@ -93,9 +259,20 @@ def login():
             # 2FA CHECK
             # ============================================
             
+            # Sessions expire after PERMANENT_SESSION_LIFETIME (default: 1 hour).
+            # Set once here rather than on every auth request; the flag is
+            # stored in the cookie and carries over to later requests.
+            session.permanent = True
+            
             if user.two_factor_method in ['email', 'app', 'sms']:
-                session['2fa_user_id'] = user.id
-                session['remember_me'] = remember
+                # Pending 2FA state travels in the signed session cookie so
+                # verify_2fa can reject wrong codes without a DB query
+                pending = {
+                    'uid': user.id,
+                    'username': user.username,
+                    'method': user.two_factor_method,
+                    'remember': remember,
+                }
                 
                 # Case 1: Authenticator App (TOTP)
                 if user.two_factor_method == 'app':
@@ -103,26 +280,25 @@ def login():
                 
                 # Case 2: Email OTP
                 elif user.two_factor_method == 'email':
-                    # Generate and send OTP
+                    # Generate and send OTP (delivery runs in a background thread)
                     otp = generate_otp()
-                    user.otp_code = otp
-                    user.otp_expiry = datetime.utcnow() + timedelta(minutes=10)
-                    db.session.commit()
+                    pending['otp'] = _store_otp(user.id, otp)
+                    pending['exp'] = time.time() + _OTP_TTL.total_seconds()
                     
                     send_email_otp(user.email, otp)
                     flash(f'Verification code sent to {user.email}', 'info')
                 
                 # Case 3: SMS OTP (if configured)
                 elif user.two_factor_method == 'sms':
-                    from utils import send_sms_otp
                     otp = generate_otp()
-                    user.otp_code = otp
-                    user.otp_expiry = datetime.utcnow() + timedelta(minutes=10)
-                    db.session.commit()
+                    pending['otp'] = _store_otp(user.id, otp)
+                    pending['exp'] = time.time() + _OTP_TTL.total_seconds()
                     
                     send_sms_otp(user.phone, otp)
                     flash(f'Verification code sent to {user.phone}', 'info')
                 
+                session['2fa'] = pending
+                
                 # Redirect to 2FA verification
                 if request.is_json:
                     return jsonify({'success': True, 'redirect': url_for('auth.verify_2fa')})
@@ -132,8 +308,7 @@ def login():
             # NO 2FA (Direct Login)
             # ============================================
             
-            user.last_login = datetime.utcnow()
-            db.session.commit()
+            record_last_login(user.id)
             login_user(user, remember=remember)
             
             # Log successful login
@@ -149,11 +324,12 @@ def login():
         # FAILED LOGIN
         # ============================================
         
+        _login_failures.hit(failure_key)
         log_failed_login(username, 'Invalid credentials')
-        flash('Invalid username or password', 'error')
         
         if request.is_json:
             return jsonify({'success': False, 'error': 'Invalid credentials'}), 401
+        return render_template('login.html', error='Invalid username or password')
 
     return render_template('login.html')
 
@@ -165,77 +341,85 @@ def verify_2fa():
     Two-factor authentication verification endpoint.
     
     Verifies OTP codes from email, SMS, or authenticator apps.
+    
+    Email/SMS codes are checked against the pending state that login
+    stored in the session, so failed attempts cost no user query; the
+    database is only touched to consume the code on success.
     """
-    user_id = session.get('2fa_user_id')
-    if not user_id:
+    pending = session.get('2fa')
+    if not pending:
         flash('Session expired. Please login again.', 'warning')
         return redirect(url_for('auth.login'))
     
-    user = User.query.get(user_id)
-    if not user:
-        flash('Invalid session. Please login again.', 'error')
-        return redirect(url_for('auth.login'))
+    method = pending['method']
         
     if request.method == 'POST':
         code = request.form.get('otp_code', '').strip()
         verified = False
+        user = None
+
+        # Malformed codes never reach the TOTP HMAC or the OTP comparison
+        if not _OTP_RE.match(code):
+            flash('Enter the 6-digit verification code.', 'error')
 
         # ============================================
         # VERIFY TOTP (Authenticator App)
         # ============================================
         
-        if user.two_factor_method == 'app':
-            if verify_totp(user, code):
+        elif method == 'app':
+            user = get_cached_user(pending['uid'])
+            if user and verify_totp(user, code):
                 verified = True
             else:
-                log_failed_login(user.username, '2FA App code invalid')
+                log_failed_login(pending['username'], '2FA App code invalid')
                 flash('Invalid Authenticator code. Please try again.', 'error')
 
         # ============================================
         # VERIFY EMAIL/SMS OTP
         # ============================================
         
-        elif user.two_factor_method in ['email', 'sms']:
-            if not user.otp_code or not user.otp_expiry:
+        elif method in ['email', 'sms']:
+            if 'otp' not in pending:
                 flash('No verification code found. Please login again.', 'warning')
                 return redirect(url_for('auth.login'))
             
-            if user.otp_expiry < datetime.utcnow():
-                log_failed_login(user.username, '2FA OTP expired')
+            if pending['exp'] < time.time():
+                log_failed_login(pending['username'], '2FA OTP expired')
                 flash('Verification code has expired. Please login again.', 'warning')
-                session.pop('2fa_user_id', None)
-                session.pop('remember_me', None)
+                session.pop('2fa', None)
                 return redirect(url_for('auth.login'))
             
-            if user.otp_code == code:
-                verified = True
-            else:
-                log_failed_login(user.username, '2FA OTP invalid')
+            if not hmac.compare_digest(_otp_digest(code), pending['otp']):
+                log_failed_login(pending['username'], '2FA OTP invalid')
                 flash('Invalid verification code. Please check your message.', 'error')
+            elif not _consume_otp(pending['uid'], code):
+                # Already used (or superseded by a newer login attempt)
+                session.pop('2fa', None)
+                flash('Verification code is no longer valid. Please login again.', 'warning')
+                return redirect(url_for('auth.login'))
+            else:
+                verified = True
+                user = get_cached_user(pending['uid'])
         
         # ============================================
         # COMPLETE LOGIN IF VERIFIED
         # ============================================
         
         if verified:
+            if not user or not user.is_active:
+                session.pop('2fa', None)
+                flash('Invalid session. Please login again.', 'error')
+                return redirect(url_for('auth.login'))
+            
             try:
-                # Clear OTP data
-                user.otp_code = None
-                user.otp_expiry = None
-                user.last_login = datetime.utcnow()
-                db.session.commit()
-                
-                # Get remember me preference
-                remember = session.get('remember_me', False)
-                session.pop('2fa_user_id', None)
-                session.pop('remember_me', None)
+                record_last_login(user.id)
+                session.pop('2fa', None)
                 
                 # Log user in
-                login_user(user, remember=remember)
+                login_user(user, remember=pending.get('remember', False))
                 
                 # Log successful 2FA login
-                method = f"2fa_{user.two_factor_method}"
-                log_successful_login(user.id, user.username, method=method)
+                log_successful_login(user.id, user.username, method=f"2fa_{method}")
                 
                 flash(f'Welcome back, {user.full_name or user.username}!', 'success')
                 return redirect(url_for('main.index'))
@@ -246,7 +430,7 @@ def verify_2fa():
                 flash('An error occurred. Please try again.', 'error')
                 return redirect(url_for('auth.login'))
     
-    return render_template('verify_2fa.html', method=user.two_factor_method)
+    return render_template('verify_2fa.html', method=method)
 
 
 @auth.route('/logout')
@@ -264,6 +448,7 @@ def logout():
     log_logout(user_id, username)
     
     # Perform logout
+    invalidate_user_cache(user_id)
     logout_user()
     session.clear()
     
@@ -283,7 +468,7 @@ def register():
     In production, user accounts should be created by administrators.
     This route is kept for future self-registration features.
     """
-    if current_user.is_authenticated:
+    if _already_logged_in():
         return redirect(url_for('main.index'))
     
     if request.method == 'POST':
@@ -306,12 +491,12 @@ def forgot_password():
     Sends password reset link to user's email.
     Uses email enumeration protection.
     """
-    if current_user.is_authenticated:
+    if _already_logged_in():
         return redirect(url_for('main.index'))
         
     if request.method == 'POST':
-        email = request.form.get('email', '').strip()
-        user = User.query.filter_by(email=email).first()
+        email = request.form.get('email', '').strip().lower()
+        user = get_user_by_email(email)
         
         # Security: Always show success message (prevent email enumeration)
         if user and user.is_active:
@@ -344,29 +529,19 @@ def reset_password(token):
     Args:
         token (str): Password reset token from email link
     """
-    if current_user.is_authenticated:
+    if _already_logged_in():
         return redirect(url_for('main.index'))
     
-    # ============================================
-    # CHECK IF TOKEN WAS ALREADY USED
-    # ============================================
-    
-    if UsedPasswordResetToken.is_token_used(token):
-        flash(
-            'This password reset link has already been used. '
-            'Please request a new one if needed.',
-            'error'
-        )
-        return redirect(url_for('auth.forgot_password'))
-    
     # ============================================
     # VERIFY TOKEN SIGNATURE AND EXPIRATION
     # ============================================
     
+    # Checked first: forged or expired links are rejected in memory and
+    # never cost a used-token lookup
     try:
-        serializer = URLSafeTimedSerializer(current_app.config['SECRET_KEY'])
+        serializer = current_app.extensions['reset_serializer']
         # Token expires after 1 hour
-        email = serializer.loads(token, salt='password-reset-salt', max_age=3600)
+        email = serializer.loads(token, max_age=3600)
     except SignatureExpired:
         flash('The reset link has expired. Please request a new one.', 'error')
         return redirect(url_for('auth.forgot_password'))
@@ -374,6 +549,19 @@ def reset_password(token):
         flash('Invalid reset link.', 'error')
         return redirect(url_for('auth.forgot_password'))
     
+    # ============================================
+    # CHECK IF TOKEN WAS ALREADY USED
+    # ============================================
+    
+    # Only when showing the form: a POST is settled by try_consume() below
+    if request.method == 'GET' and UsedPasswordResetToken.is_token_used(token):
+        flash(
+            'This password reset link has already been used. '
+            'Please request a new one if needed.',
+            'error'
+        )
+        return redirect(url_for('auth.forgot_password'))
+    
     # ============================================
     # PROCESS PASSWORD RESET
     # ============================================
@@ -388,22 +576,23 @@ def reset_password(token):
             return render_template('reset_password.html', token=token)
         
         # Find user
-        user = User.query.filter_by(email=email).first()
+        user = get_user_by_email(email)
         if not user:
             flash('User not found.', 'error')
             return redirect(url_for('auth.login'))
         
+        # Consume the token before changing anything (single use, race-free);
+        # the used-token row commits together with the new password
+        if not UsedPasswordResetToken.try_consume(token, email, ip_address=get_client_ip()):
+            db.session.rollback()
+            flash('This password reset link has already been used.', 'error')
+            return redirect(url_for('auth.forgot_password'))
+        
         try:
             # Set new password (will validate complexity)
             user.set_password(password)
             db.session.commit()
-            
-            # Mark token as used
-            UsedPasswordResetToken.mark_token_used(
-                token, 
-                email, 
-                ip_address=get_client_ip()
-            )
+            invalidate_user_cache(user.id)
             
             # Log password change
             log_password_change(user.id, changed_by_admin=False)
@@ -421,10 +610,13 @@ def reset_password(token):
             
         except ValueError as e:
             # Password validation failed
+            db.session.rollback()
+            UsedPasswordResetToken.release_token(token)
             flash(str(e), 'error')
             return render_template('reset_password.html', token=token)
         except Exception as e:
             db.session.rollback()
+            UsedPasswordResetToken.release_token(token)
             current_app.logger.error(f"Password reset error: {e}")
             flash('An error occurred. Please try again.', 'error')
             return render_template('reset_password.html', token=token)
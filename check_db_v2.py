@@ -3,6 +3,7 @@ import sqlite3
 from app import create_app
 from extensions import db
 from models import Student
+from face_handler import FaceHandler
 
 app = create_app()
 with app.app_context():
@@ -13,4 +14,5 @@ with app.app_context():
     
     if with_encoding > 0:
         s = Student.query.filter(Student.face_encoding.isnot(None)).first()
-        print(f"Sample encoding (first 5 values): {s.face_encoding[:5] if s.face_encoding else 'None'}")
+        encoding = FaceHandler.unpack(s.face_encoding)
+        print(f"Sample encoding (first 5 values): {encoding[:5].tolist() if encoding is not None else 'None'}")
@@ -9,7 +9,7 @@ Table of Contents
     2.2 Database Config
     2.3 File Uploads
     2.4 Email & SMS
-    2.5 Rate Limiting
+    2.5 Redis, Cache & Rate Limiting
 3.  Environment Validation
 4.  Config Exports
 
@@ -20,8 +20,31 @@ Last Updated: 2026-02-13
 """
 
 import os
+import re
+import tempfile
 from datetime import timedelta
+from functools import lru_cache
 import sys
+from dotenv import load_dotenv
+from sqlalchemy.pool import NullPool
+
+# Config values below are read from the environment once, when this
+# module is imported, so .env has to be loaded before the class body runs
+load_dotenv()
+
+
+def _env_flag(name, default=False):
+    """Read a boolean environment variable ('1', 'true', 'yes', 'on')."""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# Deployment environment, read once: serverless platforms have a
+# read-only filesystem (except /tmp) and short-lived instances
+IS_SERVERLESS = bool(os.environ.get('VERCEL') or os.environ.get('AWS_LAMBDA_FUNCTION_NAME'))
+IS_PRODUCTION = IS_SERVERLESS or bool(os.environ.get('PRODUCTION'))
 
 
 # ============================================
@@ -45,7 +68,7 @@ class Config:
     # Session Configuration
     PERMANENT_SESSION_LIFETIME = timedelta(hours=1)
     SESSION_COOKIE_HTTPONLY = True
-    SESSION_COOKIE_SECURE = True if os.environ.get('VERCEL') or os.environ.get('PRODUCTION') else False
+    SESSION_COOKIE_SECURE = IS_PRODUCTION
     SESSION_COOKIE_SAMESITE = 'Lax'
     
     # ============================================
@@ -59,24 +82,45 @@ class Config:
     if uri and uri.startswith("postgres://"):
         uri = uri.replace("postgres://", "postgresql://", 1)
     
+    # On serverless, talk to Neon through its pgbouncer endpoint
+    # (the "-pooler" host) so pooling happens outside the instances
+    if IS_SERVERLESS and uri and '.neon.tech' in uri and '-pooler.' not in uri:
+        uri = re.sub(r'@(ep-[^.@/]+)\.', r'@\1-pooler.', uri, count=1)
+    
     # Use PostgreSQL in production, SQLite in development
     SQLALCHEMY_DATABASE_URI = uri or 'sqlite:///school.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     
     # Connection Pool Settings (Prevents connection issues on serverless)
-    SQLALCHEMY_ENGINE_OPTIONS = {
-        "pool_pre_ping": True,  # Verify connections before using
-        "pool_recycle": 300,    # Recycle connections every 5 minutes
-        "pool_size": 10,        # Connection pool size
-        "max_overflow": 20      # Maximum overflow connections
-    }
+    if IS_SERVERLESS:
+        # Serverless instances are short-lived and may be frozen between
+        # invocations: hold no connections and leave pooling to pgbouncer
+        SQLALCHEMY_ENGINE_OPTIONS = {"poolclass": NullPool}
+    else:
+        SQLALCHEMY_ENGINE_OPTIONS = {
+            "pool_pre_ping": True,   # Verify connections before using
+            "pool_recycle": 1800,    # Recycle connections every 30 minutes
+            "pool_size": 20,         # Connection pool size
+            "max_overflow": 40,      # Maximum overflow connections
+            "pool_use_lifo": True    # Reuse the most recent connection so a warm subset stays hot
+        }
+    
+    if SQLALCHEMY_DATABASE_URI.startswith('postgresql'):
+        # Fail fast instead of hanging a request on an unreachable database;
+        # serverless allows for a suspended Neon compute waking up
+        SQLALCHEMY_ENGINE_OPTIONS["connect_args"] = {
+            "connect_timeout": 10 if IS_SERVERLESS else 5
+        }
+        if IS_SERVERLESS and 'sslmode=' not in SQLALCHEMY_DATABASE_URI:
+            # Managed Postgres for serverless deployments is reached over TLS
+            SQLALCHEMY_ENGINE_OPTIONS["connect_args"]["sslmode"] = "require"
     
     # ============================================
     # FILE UPLOAD SETTINGS
     # ============================================
     
     # Upload folder (use /tmp on serverless platforms)
-    UPLOAD_FOLDER = '/tmp' if os.environ.get('VERCEL') else 'static/uploads'
+    UPLOAD_FOLDER = '/tmp' if IS_SERVERLESS else 'static/uploads'
     
     # Maximum upload size: 16MB (for file uploads, images are limited separately)
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024
@@ -100,8 +144,8 @@ class Config:
         MAIL_USE_SSL = True
     else:
         # Allow manual override for custom ports
-        MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS', 'False') == 'True'
-        MAIL_USE_SSL = os.environ.get('MAIL_USE_SSL', 'False') == 'True'
+        MAIL_USE_TLS = _env_flag('MAIL_USE_TLS')
+        MAIL_USE_SSL = _env_flag('MAIL_USE_SSL')
     
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
@@ -115,16 +159,68 @@ class Config:
     TWILIO_AUTH_TOKEN = os.environ.get('TWILIO_AUTH_TOKEN')
     TWILIO_PHONE_NUMBER = os.environ.get('TWILIO_PHONE_NUMBER')
     
+    # ============================================
+    # REDIS (OPTIONAL)
+    # ============================================
+    
+    # Shared store for single-use reset tokens and the app cache;
+    # features fall back to the database / local disk when unset
+    REDIS_URL = os.environ.get('REDIS_URL')
+    
+    # ============================================
+    # CACHE CONFIGURATION
+    # ============================================
+    
+    # Redis keeps cached rows coherent across workers and instances
+    # (invalidating a user in one process clears it for all of them).
+    # Without Redis, fall back to a file cache that at least is shared
+    # by the workers of one machine.
+    if REDIS_URL:
+        CACHE_TYPE = 'RedisCache'
+        CACHE_REDIS_URL = REDIS_URL
+        CACHE_KEY_PREFIX = 'schoolsync:cache:'
+    else:
+        CACHE_TYPE = 'FileSystemCache'
+        CACHE_DIR = os.path.join(tempfile.gettempdir(), 'schoolsync-cache')
+        CACHE_THRESHOLD = 1000  # Max cached files before old entries are pruned
+    CACHE_DEFAULT_TIMEOUT = 300
+    
+    # Server-side sessions: with Redis the cookie only carries a session
+    # ID and session writes are a single SETEX instead of re-signing the
+    # whole payload. Without Redis, Flask's signed cookie sessions are used.
+    if REDIS_URL:
+        SESSION_TYPE = 'redis'
+        SESSION_PERMANENT = False  # login() marks the session permanent itself
+        SESSION_KEY_PREFIX = 'schoolsync:session:'
+    
     # ============================================
     # RATE LIMITING CONFIGURATION
     # ============================================
     
-    # Use Redis in production, memory    # 2.5 Rate Limiting
-    RATELIMIT_STORAGE_URL = os.environ.get('RATELIMIT_STORAGE_URL', 'memory://')
+    # Use Redis in production, memory only for local development.
+    # memory:// counters are per-process, so every gunicorn worker or
+    # serverless instance would enforce its own copy of each limit.
+    RATELIMIT_STORAGE_URL = (
+        os.environ.get('RATELIMIT_STORAGE_URL')
+        or os.environ.get('REDIS_URL')
+        or 'memory://'
+    )
+    RATELIMIT_STORAGE_URI = RATELIMIT_STORAGE_URL  # Key read by Flask-Limiter
+
+    # fixed-window is a single INCR per hit; moving-window keeps a sorted
+    # set per key and runs a Lua script (EVALSHA) that trims, counts and
+    # inserts atomically. It is exact at window edges but costs more on
+    # hot keys like /login, so it is opt-in.
+    RATELIMIT_STRATEGY = os.environ.get('RATELIMIT_STRATEGY', 'fixed-window')
+
+    # Share one bounded connection pool per worker for limiter traffic
+    if RATELIMIT_STORAGE_URL.startswith(('redis://', 'rediss://')):
+        RATELIMIT_STORAGE_OPTIONS = {'max_connections': 32}
 
     # 2.6 Automation (n8n)
     N8N_WEBHOOK_URL = os.environ.get('N8N_WEBHOOK_URL', 'https://brokentrinity.app.n8n.cloud/webhook-test/student-events')
-    RATELIMIT_DEFAULT = os.environ.get('RATELIMIT_DEFAULT', '5000 per day;1000 per hour')
+    # One default rule: every extra rule is another storage round-trip per request
+    RATELIMIT_DEFAULT = os.environ.get('RATELIMIT_DEFAULT', '1000 per hour')
     
     # ============================================
     # APPLICATION SETTINGS
@@ -192,10 +288,34 @@ def validate_development_config():
         print()
 
 
+def validate_config():
+    """
+    Run the checks for the current environment and report the result.
+    
+    Called by create_app() rather than at import, so importing config
+    (scripts, CLI helpers, tests) has no side effects. A production
+    configuration error is printed but does not stop the app starting.
+    """
+    if IS_PRODUCTION:
+        try:
+            validate_production_config()
+            print("✅ Production configuration validated", file=sys.stdout)
+        except ValueError:
+            # Let application handle this, don't crash on startup
+            pass
+    elif os.environ.get('FLASK_ENV') == 'development':
+        validate_development_config()
+
+
+@lru_cache(maxsize=1)
 def get_config_info():
     """
     Get configuration information for debugging.
     
+    Config values are fixed once the class is loaded, so the summary is
+    built on the first call and the same dict is returned afterwards
+    (treat it as read-only).
+    
     Returns:
         dict: Configuration summary (sanitized, no secrets)
     """
@@ -219,19 +339,3 @@ config = {
     'production': Config,
     'default': Config
 }
-
-
-# ============================================
-# AUTO-VALIDATION
-# ============================================
-
-# Automatically validate on import if PRODUCTION is set
-if os.environ.get('PRODUCTION') or os.environ.get('VERCEL'):
-    try:
-        validate_production_config()
-        print("✅ Production configuration validated", file=sys.stdout)
-    except ValueError:
-        # Let application handle this, don't crash on import
-        pass
-elif os.environ.get('FLASK_ENV') == 'development':
-    validate_development_config()
\ No newline at end of file
@@ -1,21 +1,176 @@
+from flask import current_app, request
 from flask_sqlalchemy import SQLAlchemy
-from flask_login import LoginManager
+from flask_login import LoginManager, current_user
 from flask_wtf.csrf import CSRFProtect
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_caching import Cache
-from flask_migrate import Migrate
-from flask_mail import Mail
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # Optional: Flask's stdlib json provider is used instead
+    orjson = None
 
 # Initialize extensions (unbound)
 db = SQLAlchemy()
 csrf = CSRFProtect()
-limiter = Limiter(
-    key_func=get_remote_address,
-    default_limits=["5000 per day", "1000 per hour"],
-    storage_uri="memory://"
-)
+# Storage backend, strategy and default limits ("a;b" string in
+# RATELIMIT_DEFAULT) come from RATELIMIT_* app config (see config.py)
+limiter = Limiter(key_func=get_remote_address)
 cache = Cache()
-migrate = Migrate()
-mail = Mail()
+# Flask-Mail and Flask-Migrate are set up on demand: see get_mail() and
+# init_migrate(); the login path needs neither on a cold start
 login_manager = LoginManager()
+
+
+def get_redis():
+    """
+    Return the shared Redis client for the current app.
+    
+    The client is created on first use from REDIS_URL (the redis package
+    is only imported then). Returns None when Redis is not configured so
+    callers can fall back to the database.
+    """
+    app = current_app._get_current_object()
+    if 'redis' not in app.extensions:
+        url = app.config.get('REDIS_URL')
+        if url:
+            import redis
+            app.extensions['redis'] = redis.Redis.from_url(url)
+        else:
+            app.extensions['redis'] = None
+    return app.extensions['redis']
+
+
+def cache_ready():
+    """
+    Return True if the app cache was initialised for the current app.
+    
+    create_app() only logs a warning when cache.init_app() fails, so
+    callers on the login path check this and go to the database instead
+    of letting the unbound cache raise.
+    """
+    return cache in current_app.extensions.get('cache', {})
+
+
+def cached_view(timeout=60, per_user=True):
+    """
+    Cache a GET view's successful responses in the app cache.
+    
+    Entries are keyed on the full path (including the query string) and,
+    unless per_user is False, on the logged-in user. Apply below
+    @login_required so anonymous requests never reach the cache. Only
+    use on views that may serve data up to `timeout` seconds old.
+    
+    Args:
+        timeout (int): Seconds a response is served from the cache
+        per_user (bool): Keep a separate entry for each user
+        
+    Returns:
+        callable: View decorator
+    """
+    def make_cache_key(*args, **kwargs):
+        user_part = current_user.get_id() if per_user else 'all'
+        return f"view:{user_part}:{request.full_path}"
+    
+    return cache.cached(
+        timeout=timeout,
+        make_cache_key=make_cache_key,
+        unless=lambda: request.method != 'GET',
+        response_filter=lambda response: getattr(response, 'status_code', 200) == 200
+    )
+
+
+def get_mail():
+    """
+    Return the Flask-Mail instance for the current app.
+    
+    flask_mail is imported and bound to the app on the first email sent,
+    so requests that never send mail do not pay for it.
+    """
+    app = current_app._get_current_object()
+    if 'schoolsync_mail' not in app.extensions:
+        from flask_mail import Mail
+        app.extensions['schoolsync_mail'] = Mail(app)
+    return app.extensions['schoolsync_mail']
+
+
+def init_migrate(app):
+    """
+    Register Flask-Migrate (the `flask db` commands) on the app.
+    
+    Only needed when the app is loaded by the flask CLI.
+    """
+    from flask_migrate import Migrate
+    Migrate(app, db)
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    """
+    Flask JSON provider backed by orjson.
+    
+    Output matches the default provider: keys are sorted, non-string keys
+    are converted, and datetimes, Decimals and other unsupported types go
+    through the same default() hook (so dates stay in HTTP format).
+    orjson emits UTF-8 rather than ASCII escapes. Pretty-printed debug
+    responses and calls with stdlib-only options fall back to json.
+    """
+    
+    _options = (
+        orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+        | orjson.OPT_PASSTHROUGH_DATETIME
+    ) if orjson is not None else 0
+    
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self._options).decode()
+    
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(
+            obj, default=self.default,
+            option=self._options | orjson.OPT_APPEND_NEWLINE
+        )
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def init_json(app):
+    """
+    Serialise JSON responses with orjson when it is installed.
+    
+    Without orjson the app keeps Flask's default provider.
+    """
+    if orjson is not None:
+        app.json = ORJSONProvider(app)
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Switch a new SQLite connection to WAL with NORMAL syncing."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def init_sqlite(app):
+    """
+    Tune SQLite (the local development database) for concurrent requests.
+    
+    SQLAlchemy already pools SQLite connections; each new one is put in
+    WAL mode so page loads can read while another request writes, with
+    fsync only at checkpoints. Does nothing for other databases.
+    """
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        return
+    from sqlalchemy import event
+    with app.app_context():
+        event.listen(db.engine, 'connect', _set_sqlite_pragmas)
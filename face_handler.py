@@ -1,33 +1,251 @@
-import numpy as np
 import json
 import base64
+import logging
 import os
-from flask import current_app
+import threading
+
+# Records go wherever the app's logging sends them (see setup_logging);
+# without a configured handler they are dropped at no cost
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# Encoded images above this size (roughly 3+ megapixel photos) are
+# decoded at half resolution, still well above the detector input sizes
+LARGE_IMAGE_BYTES = 1_500_000
+
+# Stored encodings: 128 little-endian float16 values (256 bytes per face)
+ENCODING_DIM = 128
+ENCODING_DTYPE = '<f2'
+ENCODING_BYTES = ENCODING_DIM * 2
+
+# get_encoding_batch(): aligned faces per SFace forward pass, and threads
+# decoding images ahead of detection
+BATCH_SIZE = 32
+DECODE_THREADS = 4
+
+# Largest detector input tried first; bigger images only retry at the
+# full DETECTOR_SIZES range when no face is found
+FIRST_PASS_SIZE = 640
+MIN_FACE_PX = 64
+
+# Threads OpenCV may use per call (resize, decode, inference)
+CV_THREADS = int(os.environ.get('CV_THREADS', 2))
+
+_BASE = os.path.dirname(os.path.abspath(__file__))
+_UPLOAD_DIR = os.path.join(_BASE, 'static', 'uploads')
+_DET_MODEL = os.path.join(_BASE, 'static', 'models', 'face_detection_yunet_2023mar.onnx')
+_REC_MODEL = os.path.join(_BASE, 'static', 'models', 'face_recognition_sface_2021dec.onnx')
 
 class FaceHandler:
-    _detector = None
+    # YuNet input sizes. Images are letterboxed into the smallest size that
+    # fits, and each size keeps its own detector, so OpenCV never has to
+    # reallocate its buffers for a new input shape.
+    DETECTOR_SIZES = (320, 640, 960)
+
+    _detectors = {}
     _recognizer = None
+    _feature_net = None
+    _models_missing = False
+
+    # Serializes model loading: gthread workers can hit the first face
+    # request from several threads at once
+    _lock = threading.Lock()
+
+    # OpenCV models keep per-call state in the network object and are not
+    # thread-safe, so each shared instance runs one inference at a time.
+    # A lock per model (rather than a model per thread) keeps one copy of
+    # the weights per worker process.
+    _detector_locks = {size: threading.Lock() for size in DETECTOR_SIZES}
+    _recognizer_lock = threading.Lock()
+    _feature_net_lock = threading.Lock()
     
     @classmethod
     def _get_models(cls):
-        """Initialize the OpenCV models if not already loaded"""
-        import cv2
-        if cls._detector is None or cls._recognizer is None:
-            # Paths to models
-            base_path = os.path.dirname(os.path.abspath(__file__))
-            det_model_path = os.path.join(base_path, 'static', 'models', 'face_detection_yunet_2023mar.onnx')
-            rec_model_path = os.path.join(base_path, 'static', 'models', 'face_recognition_sface_2021dec.onnx')
-            
-            if not os.path.exists(det_model_path) or not os.path.exists(rec_model_path):
-                print(f"Face models not found at {det_model_path} or {rec_model_path}")
-                return None, None
-
-            # Initialize detector with a dummy input size, will be updated per image
-            # Lowered score threshold from 0.3 to 0.2 for better detection in low light/small faces
-            cls._detector = cv2.FaceDetectorYN.create(det_model_path, "", (320, 320), 0.2)
-            cls._recognizer = cv2.FaceRecognizerSF.create(rec_model_path, "")
+        """Check the model files and load the SFace recognizer once"""
+        if cls._recognizer is not None or cls._models_missing:
+            return cls._recognizer
+
+        with cls._lock:
+            if cls._recognizer is None and not cls._models_missing:
+                # Checked once per process; installing the models needs a restart
+                if not os.path.exists(_DET_MODEL) or not os.path.exists(_REC_MODEL):
+                    log.warning("Face models not found at %s or %s", _DET_MODEL, _REC_MODEL)
+                    cls._models_missing = True
+                else:
+                    import cv2
+                    # OpenCV defaults to a thread per core for every call,
+                    # which oversubscribes the CPU under threaded workers
+                    cv2.setNumThreads(CV_THREADS)
+                    cls._recognizer = cv2.FaceRecognizerSF.create(_REC_MODEL, "")
             
-        return cls._detector, cls._recognizer
+        return cls._recognizer
+
+    @classmethod
+    def _get_detector(cls, size):
+        """Return the YuNet detector for a (size x size) input, creating it once"""
+        detector = cls._detectors.get(size)
+        if detector is None:
+            with cls._lock:
+                detector = cls._detectors.get(size)
+                if detector is None:
+                    import cv2
+                    # Lowered score threshold from 0.3 to 0.2 for better detection in low light/small faces
+                    detector = cv2.FaceDetectorYN.create(_DET_MODEL, "", (size, size), 0.2)
+                    cls._detectors[size] = detector
+        return detector
+
+    @classmethod
+    def warm_up(cls):
+        """
+        Load the recognizer and run every detector once ahead of traffic.
+
+        OpenCV only builds a network on its first inference, so a dummy
+        pass per input size moves that cost out of the first face search.
+
+        Returns:
+            bool: True if the models are ready
+        """
+        try:
+            import numpy as np
+            recognizer = cls._get_models()
+            if recognizer is None:
+                return False
+            for size in cls.DETECTOR_SIZES:
+                detector = cls._get_detector(size)
+                with cls._detector_locks[size]:
+                    detector.detect(np.zeros((size, size, 3), np.uint8))
+            with cls._recognizer_lock:
+                recognizer.feature(np.zeros((112, 112, 3), np.uint8))
+            return True
+        except Exception as e:
+            log.warning("Face models not warmed up: %s", e)
+            return False
+
+    @classmethod
+    def _letterbox(cls, img, max_size=None):
+        """
+        Fit img into the smallest detector size and pad it to a square.
+
+        The image is only ever scaled down, and padding goes on the
+        bottom/right, so detections map back to img by dividing by scale.
+
+        Returns:
+            tuple: (padded image, detector size, scale)
+        """
+        import cv2
+        sizes = [s for s in cls.DETECTOR_SIZES if max_size is None or s <= max_size]
+        h, w = img.shape[:2]
+        longest = max(h, w)
+        size = next((s for s in sizes if s >= longest), sizes[-1])
+
+        scale = min(1.0, size / longest)
+        if scale < 1.0:
+            img = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))),
+                             interpolation=cv2.INTER_AREA)
+        padded = cv2.copyMakeBorder(img, 0, size - img.shape[0], 0, size - img.shape[1],
+                                    cv2.BORDER_CONSTANT, value=0)
+        return padded, size, scale
+
+    @staticmethod
+    def _decode(image_data):
+        """Decode encoded image bytes into a BGR image (None if undecodable)"""
+        import cv2
+        import numpy as np
+        # Large uploads are far bigger than the detector input;
+        # decoding at half size skips most of the JPEG work
+        flags = cv2.IMREAD_REDUCED_COLOR_2 if len(image_data) > LARGE_IMAGE_BYTES else cv2.IMREAD_COLOR
+        return cv2.imdecode(np.frombuffer(image_data, np.uint8), flags)
+
+    @staticmethod
+    def _read_file(path):
+        """Read and decode an image file, or return None if it cannot be opened"""
+        try:
+            with open(path, 'rb') as f:
+                image_data = f.read()
+        except OSError:
+            return None
+        return FaceHandler._decode(image_data)
+
+    @staticmethod
+    def _load_image(image_source):
+        """
+        Turn a data URI, file path/upload filename or array into a BGR image.
+
+        Returns None if the source cannot be found or decoded; malformed
+        base64 raises so callers can log it.
+        """
+        import numpy as np
+        if isinstance(image_source, np.ndarray):
+            return image_source
+        if not isinstance(image_source, str):
+            return None
+
+        if image_source.startswith("data:"):
+            # Handle base64 data URI
+            image_data = base64.b64decode(image_source[image_source.index(",") + 1:])
+            return FaceHandler._decode(image_data)
+
+        # Handle file path; open() failing replaces the exists() probes
+        img = FaceHandler._read_file(image_source)
+        if img is None and os.sep not in image_source and '/' not in image_source:
+            # Try as a relative path from static/uploads if it's just a filename
+            img = FaceHandler._read_file(os.path.join(_UPLOAD_DIR, image_source))
+        return img
+
+    @staticmethod
+    def _align(img, recognizer):
+        """Detect the first face in img and return its aligned 112x112 crop, or None"""
+        import cv2
+        import numpy as np
+
+        # Detect faces on the letterboxed image, at most 640x640 first:
+        # YuNet is trained at 320x320 and bigger inputs rarely help
+        padded, size, scale = FaceHandler._letterbox(img, max_size=FIRST_PASS_SIZE)
+        detector = FaceHandler._get_detector(size)
+        with FaceHandler._detector_locks[size]:
+            _, faces = detector.detect(padded)
+        
+        # Helper to check if faces were found safely for numpy arrays
+        def has_faces(f):
+            return f is not None and isinstance(f, np.ndarray) and f.size > 0
+
+        # Faces only a few dozen pixels wide at this size give poor landmarks;
+        # retry large images at the biggest input size for those and misses
+        too_small = has_faces(faces) and faces[0][2] < MIN_FACE_PX
+        if (not has_faces(faces) or too_small) and max(img.shape[:2]) > size:
+            padded_large, size_large, scale_large = FaceHandler._letterbox(img)
+            detector_large = FaceHandler._get_detector(size_large)
+            with FaceHandler._detector_locks[size_large]:
+                _, faces_large = detector_large.detect(padded_large)
+            if has_faces(faces_large):
+                faces, padded, scale = faces_large, padded_large, scale_large
+                detector, size = detector_large, size_large
+            del padded_large
+
+        def to_gray(image):
+            return cv2.cvtColor(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), cv2.COLOR_GRAY2BGR)
+
+        # Grayscale fallback
+        gray = False
+        if not has_faces(faces):
+            gray_padded = to_gray(padded)
+            with FaceHandler._detector_locks[size]:
+                _, faces = detector.detect(gray_padded)
+            gray = has_faces(faces)
+        del padded
+
+        if not has_faces(faces):
+            return None
+
+        # Use the first face found, mapping its box and landmarks
+        # (first 14 values) back to the full-resolution image
+        face = faces[0].copy()
+        face[:14] /= scale
+        with FaceHandler._recognizer_lock:
+            aligned_face = recognizer.alignCrop(img, face)
+        # The affine warp and the grayscale conversion commute, so only the
+        # 112x112 crop is converted instead of a gray copy of the full image
+        return to_gray(aligned_face) if gray else aligned_face
 
     @staticmethod
     def get_encoding(image_source):
@@ -36,94 +254,167 @@ class FaceHandler:
         Returns a list of 128 floats or None if no face is found.
         """
         try:
-            import cv2
-            img = None
             if image_source is None:
                 return None
 
-            if isinstance(image_source, str):
-                if image_source.startswith("data:"):
-                    # Handle base64 data URI
-                    try:
-                        header, encoded = image_source.split(",", 1)
-                        image_data = base64.b64decode(encoded)
-                        nparr = np.frombuffer(image_data, np.uint8)
-                        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-                    except Exception as e:
-                        current_app.logger.error(f"FaceHandler: Failed to decode base64 image: {e}")
-                        return None
-                elif os.path.exists(image_source):
-                    # Handle file path
-                    img = cv2.imread(image_source)
-                else:
-                    # Try as a relative path from static/uploads if it's just a filename
-                    base_path = os.path.dirname(os.path.abspath(__file__))
-                    upload_path = os.path.join(base_path, 'static', 'uploads', image_source)
-                    if os.path.exists(upload_path):
-                        img = cv2.imread(upload_path)
-            elif isinstance(image_source, np.ndarray):
-                img = image_source
+            try:
+                img = FaceHandler._load_image(image_source)
+            except Exception as e:
+                log.error("FaceHandler: Failed to decode base64 image: %s", e)
+                return None
             
             if img is None:
                 return None
 
-            detector, recognizer = FaceHandler._get_models()
-            if detector is None:
+            recognizer = FaceHandler._get_models()
+            if recognizer is None:
                 return None
 
-            # Update detector input size
-            h, w, _ = img.shape
-            detector.setInputSize((w, h))
-            
-            # Detect faces
-            _, faces = detector.detect(img)
-            
-            # Helper to check if faces were found safely for numpy arrays
-            def has_faces(f):
-                return f is not None and isinstance(f, np.ndarray) and f.size > 0
-
-            if not has_faces(faces):
-                # Try with a smaller input size if the image is large, sometimes helps YuNet
-                if w > 640 or h > 640:
-                    scale = 640.0 / max(w, h)
-                    img_small = cv2.resize(img, (0,0), fx=scale, fy=scale)
-                    detector.setInputSize((img_small.shape[1], img_small.shape[0]))
-                    _, faces_small = detector.detect(img_small)
-                    if has_faces(faces_small):
-                        faces = faces_small
-                        img = img_small
-
-            # Grayscale fallback
-            if not has_faces(faces):
-                img_gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-                img_gray = cv2.cvtColor(img_gray, cv2.COLOR_GRAY2BGR)
-                _, faces_gray = detector.detect(img_gray)
-                if has_faces(faces_gray):
-                    faces = faces_gray
-                    img = img_gray
-
-            if has_faces(faces):
-                # Use the first face found
-                # Align and crop the face
-                aligned_face = recognizer.alignCrop(img, faces[0])
-                # Extract features
+            aligned_face = FaceHandler._align(img, recognizer)
+            if aligned_face is None:
+                return None
+
+            # Extract features and convert from [1, 128] numpy array to list
+            with FaceHandler._recognizer_lock:
                 feature = recognizer.feature(aligned_face)
-                # Convert from [1, 128] numpy array to list
-                return feature[0].tolist()
+            return feature[0].tolist()
+        except Exception:
+            log.exception("Error extracting face encoding")
+            return None
+
+    @classmethod
+    def _get_feature_net(cls):
+        """Load the SFace network once for batched feature extraction"""
+        if cls._feature_net is None:
+            with cls._lock:
+                if cls._feature_net is None:
+                    import cv2
+                    cls._feature_net = cv2.dnn.readNet(_REC_MODEL)
+        return cls._feature_net
+
+    @staticmethod
+    def get_encoding_batch(sources, chunk_size=BATCH_SIZE):
+        """
+        Get face encodings for many images, e.g. for bulk re-encoding.
 
+        Images are decoded on a thread pool (OpenCV releases the GIL while
+        decoding), detected and aligned one by one, and the aligned crops
+        of each chunk go through SFace in a single batched forward pass.
+        
+        Args:
+            sources (list): Image sources, as accepted by get_encoding()
+            chunk_size (int): Images decoded and encoded per batch
+        
+        Returns:
+            list: One 128-float list, or None if no face was found, per source
+        """
+        import cv2
+        from concurrent.futures import ThreadPoolExecutor
+
+        results = [None] * len(sources)
+        if not sources:
+            return results
+
+        recognizer = FaceHandler._get_models()
+        if recognizer is None:
+            return results
+        net = FaceHandler._get_feature_net()
+
+        def load(source):
+            try:
+                return FaceHandler._load_image(source), None
+            except Exception as e:
+                return None, e
+
+        with ThreadPoolExecutor(max_workers=DECODE_THREADS) as pool:
+            for offset in range(0, len(sources), chunk_size):
+                chunk = sources[offset:offset + chunk_size]
+                indexes, crops = [], []
+                for i, (img, error) in enumerate(pool.map(load, chunk), start=offset):
+                    if error is not None:
+                        log.error("FaceHandler: Failed to decode image %d: %s", i, error)
+                        continue
+                    if img is None:
+                        continue
+                    try:
+                        aligned_face = FaceHandler._align(img, recognizer)
+                    except Exception:
+                        log.exception("Error extracting face encoding for image %d", i)
+                        continue
+                    if aligned_face is not None:
+                        indexes.append(i)
+                        crops.append(aligned_face)
+
+                if not crops:
+                    continue
+
+                # Same preprocessing as FaceRecognizerSF.feature(), for the whole chunk
+                blob = cv2.dnn.blobFromImages(crops, 1.0, (112, 112), (0, 0, 0), swapRB=True)
+                with FaceHandler._feature_net_lock:
+                    net.setInput(blob)
+                    features = net.forward()
+                for i, feature in zip(indexes, features):
+                    results[i] = feature.tolist()
+
+        return results
+
+    @staticmethod
+    def pack(encoding):
+        """
+        Pack an encoding for the Student.face_encoding column.
+        
+        Args:
+            encoding (list): 128 floats from get_encoding(), or None
+        
+        Returns:
+            bytes: 256 bytes of float16 values, or None if there is no encoding
+        """
+        if not encoding:
             return None
-        except Exception as e:
-            if current_app:
-                current_app.logger.error(f"Error extracting face encoding: {e}")
+        import numpy as np
+        return np.asarray(encoding, dtype=ENCODING_DTYPE).tobytes()
+
+    @staticmethod
+    def unpack(blob):
+        """Turn a stored encoding back into a float32 array (None if malformed)"""
+        if not blob or len(blob) != ENCODING_BYTES:
             return None
+        import numpy as np
+        return np.frombuffer(blob, dtype=ENCODING_DTYPE).astype(np.float32)
+
+    @staticmethod
+    def build_gallery(rows):
+        """
+        Stack stored encodings into a matrix that find_match() can search.
+        
+        Rows are scaled to unit length up front, so a search is a single
+        matrix-vector product. Malformed and all-zero encodings are dropped.
+        
+        Args:
+            rows (iterable): (student_id, packed encoding) pairs
+        
+        Returns:
+            tuple: (list of student IDs, (N, 128) float32 array)
+        """
+        import numpy as np
+
+        rows = [(row_id, blob) for row_id, blob in rows if blob and len(blob) == ENCODING_BYTES]
+        matrix = np.frombuffer(
+            b''.join(blob for _, blob in rows), dtype=ENCODING_DTYPE
+        ).reshape(len(rows), ENCODING_DIM).astype(np.float32)
+
+        norms = np.linalg.norm(matrix, axis=1)
+        keep = norms > 0
+        ids = [row_id for (row_id, _), kept in zip(rows, keep) if kept]
+        return ids, matrix[keep] / norms[keep, None]
 
     @staticmethod
-    def find_match(known_encodings, target_encoding, threshold=None):
+    def find_match(gallery, target_encoding, threshold=None):
         """
-        Find the best match for target_encoding among known_encodings.
+        Find the best match for target_encoding in a gallery from build_gallery().
         SFace usually works well with a cosine distance threshold around 0.36.
         """
-        if not known_encodings or not target_encoding:
+        if not gallery or not target_encoding:
             return None
 
         # Threshold for SFace (Cosine Distance: 1 - Cosine Similarity)
@@ -132,38 +423,24 @@ class FaceHandler:
         if threshold is None:
             threshold = 0.75
 
-        best_match = None
-        min_dist = float('inf')
+        import numpy as np
 
-        target_vec = np.array(target_encoding)
+        ids, matrix = gallery
+        target = np.asarray(target_encoding, dtype=np.float32)
+        target_norm = np.linalg.norm(target)
+        if not ids or target_norm == 0 or target.size != ENCODING_DIM:
+            return {'match': False, 'id': None, 'distance': 1.0, 'similarity': 0.0}
 
-        for item in known_encodings:
-            known_vec = np.array(item['encoding'])
-            
-            # Calculate cosine distance
-            try:
-                # Norm of vectors
-                norm_a = np.linalg.norm(target_vec)
-                norm_b = np.linalg.norm(known_vec)
-                if norm_a == 0 or norm_b == 0:
-                    continue
-                    
-                cos_sim = np.dot(target_vec, known_vec) / (norm_a * norm_b)
-                dist = 1 - cos_sim
-                
-                if dist < threshold and dist < min_dist:
-                    min_dist = dist
-                    best_match = {
-                        'id': item['id'],
-                        'distance': float(dist)
-                    }
-            except Exception as e:
-                print(f"Comparison error: {e}")
-                continue
+        # Gallery rows are unit length: one product gives every cosine similarity
+        similarities = matrix.dot(target / target_norm)
+
+        best = int(np.argmax(similarities))
+        min_dist = float(1 - similarities[best])
+        matched = min_dist < threshold
 
         return {
-        'match': best_match is not None,
-        'id': best_match['id'] if best_match else None,
-        'distance': float(min_dist) if min_dist != float('inf') else 1.0,
-        'similarity': float(1 - min_dist) if min_dist != float('inf') else 0.0
-    }
+            'match': matched,
+            'id': ids[best] if matched else None,
+            'distance': min_dist,
+            'similarity': 1 - min_dist
+        }
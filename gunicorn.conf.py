@@ -0,0 +1,51 @@
+"""
+Gunicorn Configuration for SchoolSync Pro
+==========================================
+Picked up automatically by `gunicorn app:app` when started from the
+project root (see entrypoint.sh). Values can be overridden per deploy
+through environment variables.
+
+Author: SchoolSync Team
+Last Updated: 2026-10-16
+"""
+
+import os
+
+
+# Threaded workers: password hashing (Argon2id through argon2-cffi, about
+# 100-150 ms of one core) runs in C with the GIL released, so a login
+# being verified no longer stalls every other request (including /static)
+# that lands on the same worker. Each hash in flight also holds 46 MiB,
+# so a worker whose 8 threads all hash at once needs ~370 MiB on top of
+# the face models; the /login rate limit keeps that rare. Lower
+# GUNICORN_THREADS on small instances.
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+
+def post_worker_init(worker):
+    """
+    Load the face models and start the last_login writer in each worker
+    before it accepts requests.
+
+    The first face search would otherwise pay for loading both ONNX
+    models (roughly 200 MB per worker). Serverless deploys do not run
+    gunicorn and keep loading them lazily. Set FACE_MODELS_WARMUP=0 to
+    skip this.
+    """
+    if os.environ.get('FACE_MODELS_WARMUP', '1') == '1':
+        from face_handler import FaceHandler
+        if FaceHandler.warm_up():
+            worker.log.info("Face models loaded")
+
+    # With Redis, every worker drains the shared pending last_login hash,
+    # not only the ones that have served a login
+    from utils import start_last_login_writer
+    start_last_login_writer(worker.wsgi)
+
+
+def worker_exit(server, worker):
+    """Write out last_login updates still pending in this worker."""
+    from utils import stop_last_login_writer
+    stop_last_login_writer()
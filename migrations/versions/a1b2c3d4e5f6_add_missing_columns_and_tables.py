@@ -22,22 +22,37 @@ def upgrade():
     inspector = inspect(conn)
     tables = inspector.get_table_names()
 
-    # 1. Add face_encoding to students if it's missing
-    columns = [c['name'] for c in inspector.get_columns('students')]
-    if 'face_encoding' not in columns:
-        with op.batch_alter_table('students', schema=None) as batch_op:
-            batch_op.add_column(sa.Column('face_encoding', sa.Text(), nullable=True))
+    # 1. Add face_encoding and the dashboard filter indexes to students if
+    # they are missing (on SQLite in one batch, which may rebuild the table).
+    # Existence is checked up front: a failed CREATE INDEX would abort the
+    # whole migration transaction on PostgreSQL.
+    columns = {c['name'] for c in inspector.get_columns('students')}
+    indexes = {ix['name'] for ix in inspector.get_indexes('students')}
+    new_indexes = [
+        (name, cols) for name, cols in (
+            ('ix_students_program_year', ['program', 'enrollment_year']),
+            ('ix_students_hall_year', ['hall', 'enrollment_year']),
+        )
+        if name not in indexes
+    ]
 
-    # Add indexes if missing
-    # (Checking indexes is more complex, but batch_op handles existing ones gracefully sometimes)
-    # To be safe, we just use batch_op which is generally idempotent for indexes in some dialects
-    # but here we'll just try to add them.
-    try:
+    if conn.dialect.name == 'postgresql':
+        if 'face_encoding' not in columns:
+            op.add_column('students', sa.Column('face_encoding', sa.Text(), nullable=True))
+        # CREATE INDEX CONCURRENTLY only takes a SHARE UPDATE EXCLUSIVE lock,
+        # so students stays readable and writable while the indexes build.
+        # It cannot run inside a transaction, hence the autocommit block.
+        if new_indexes:
+            with op.get_context().autocommit_block():
+                for name, cols in new_indexes:
+                    op.create_index(name, 'students', cols, unique=False,
+                                    postgresql_concurrently=True)
+    elif 'face_encoding' not in columns or new_indexes:
         with op.batch_alter_table('students', schema=None) as batch_op:
-            batch_op.create_index('ix_students_program_year', ['program', 'enrollment_year'], unique=False)
-            batch_op.create_index('ix_students_hall_year', ['hall', 'enrollment_year'], unique=False)
-    except Exception:
-        pass
+            if 'face_encoding' not in columns:
+                batch_op.add_column(sa.Column('face_encoding', sa.Text(), nullable=True))
+            for name, cols in new_indexes:
+                batch_op.create_index(name, cols, unique=False)
 
     # 2. Create blacklist table if missing
     if 'blacklist' not in tables:
@@ -0,0 +1,48 @@
+"""Add covering index for per-user security log timelines
+
+Revision ID: a6d3e8f15b92
+Revises: f2c84e1b6a93
+Create Date: 2026-10-16 17:00:00.000000
+
+"""
+from alembic import op
+from sqlalchemy import inspect
+
+
+# revision identifiers, used by Alembic.
+revision = 'a6d3e8f15b92'
+down_revision = 'f2c84e1b6a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    conn = op.get_bind()
+    indexes = {ix['name'] for ix in inspect(conn).get_indexes('security_logs')}
+
+    if conn.dialect.name == 'postgresql':
+        # Build without blocking audit writes (see a1b2c3d4e5f6)
+        with op.get_context().autocommit_block():
+            if 'ix_security_logs_user_event_ts' not in indexes:
+                op.create_index(
+                    'ix_security_logs_user_event_ts', 'security_logs',
+                    ['user_id', 'event_type', 'timestamp'],
+                    postgresql_include=['ip_address'],
+                    postgresql_concurrently=True
+                )
+            # (user_id, event_type) is a prefix of the new index
+            if 'ix_security_logs_user_event' in indexes:
+                op.drop_index('ix_security_logs_user_event', table_name='security_logs',
+                              postgresql_concurrently=True)
+    else:
+        if 'ix_security_logs_user_event_ts' not in indexes:
+            op.create_index('ix_security_logs_user_event_ts', 'security_logs',
+                            ['user_id', 'event_type', 'timestamp'])
+        if 'ix_security_logs_user_event' in indexes:
+            op.drop_index('ix_security_logs_user_event', table_name='security_logs')
+
+
+def downgrade():
+    op.create_index('ix_security_logs_user_event', 'security_logs',
+                    ['user_id', 'event_type'])
+    op.drop_index('ix_security_logs_user_event_ts', table_name='security_logs')
@@ -0,0 +1,35 @@
+"""Add case-insensitive unique index on users.username
+
+Revision ID: b7e4c91d2f30
+Revises: a1b2c3d4e5f6
+Create Date: 2026-10-16 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import inspect
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e4c91d2f30'
+down_revision = 'a1b2c3d4e5f6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = inspect(op.get_bind())
+    indexes = {ix['name'] for ix in inspector.get_indexes('users')}
+
+    # Login looks users up by lower(username); index that expression directly
+    if 'ix_users_username_lower' not in indexes:
+        op.create_index(
+            'ix_users_username_lower',
+            'users',
+            [sa.text('lower(username)')],
+            unique=True
+        )
+
+
+def downgrade():
+    op.drop_index('ix_users_username_lower', table_name='users')
@@ -0,0 +1,42 @@
+"""Store used reset token hashes as 16-byte BLAKE2b digests
+
+Revision ID: c3f8a2d61e47
+Revises: b7e4c91d2f30
+Create Date: 2026-10-16 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f8a2d61e47'
+down_revision = 'b7e4c91d2f30'
+branch_labels = None
+depends_on = None
+
+
+def _create_table(token_hash_type):
+    op.create_table('used_password_reset_tokens',
+        sa.Column('token_hash', token_hash_type, nullable=False),
+        sa.Column('email', sa.String(length=120), nullable=False),
+        sa.Column('used_at', sa.DateTime(), nullable=True),
+        sa.Column('ip_address', sa.String(length=45), nullable=True),
+        sa.PrimaryKeyConstraint('token_hash')
+    )
+    op.create_index('ix_used_password_reset_tokens_email',
+                    'used_password_reset_tokens', ['email'])
+    op.create_index('ix_used_password_reset_tokens_used_at',
+                    'used_password_reset_tokens', ['used_at'])
+
+
+def upgrade():
+    # SHA256 hex digests cannot be converted to BLAKE2b, and reset links
+    # are only valid for an hour, so the old rows are not carried over
+    op.drop_table('used_password_reset_tokens')
+    _create_table(sa.LargeBinary(length=16))
+
+
+def downgrade():
+    op.drop_table('used_password_reset_tokens')
+    _create_table(sa.String(length=64))
@@ -0,0 +1,34 @@
+"""Add case-insensitive index on users.email
+
+Revision ID: d91e5b3a7c08
+Revises: c3f8a2d61e47
+Create Date: 2026-10-16 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import inspect
+
+
+# revision identifiers, used by Alembic.
+revision = 'd91e5b3a7c08'
+down_revision = 'c3f8a2d61e47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = inspect(op.get_bind())
+    indexes = {ix['name'] for ix in inspector.get_indexes('users')}
+
+    # Password reset looks users up by lower(email); index that expression
+    if 'ix_users_email_lower' not in indexes:
+        op.create_index(
+            'ix_users_email_lower',
+            'users',
+            [sa.text('lower(email)')]
+        )
+
+
+def downgrade():
+    op.drop_index('ix_users_email_lower', table_name='users')
@@ -0,0 +1,91 @@
+"""Store student face encodings as packed float16 bytes
+
+Revision ID: e5a7c2b90d14
+Revises: d91e5b3a7c08
+Create Date: 2026-10-16 15:00:00.000000
+
+"""
+import json
+import struct
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5a7c2b90d14'
+down_revision = 'd91e5b3a7c08'
+branch_labels = None
+depends_on = None
+
+# 128 little-endian float16 values, as written by FaceHandler.pack()
+ENCODING = struct.Struct('<128e')
+
+
+def _convert(old_type, new_type, convert):
+    """Copy face_encoding into a column of new_type through convert(), then swap it in"""
+    conn = op.get_bind()
+    with op.batch_alter_table('students', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('face_encoding_new', new_type, nullable=True))
+
+    students = sa.table(
+        'students',
+        sa.column('id', sa.Integer),
+        sa.column('face_encoding', old_type),
+        sa.column('face_encoding_new', new_type),
+    )
+    rows = conn.execute(
+        sa.select(students.c.id, students.c.face_encoding)
+        .where(students.c.face_encoding.isnot(None))
+    ).all()
+    updates = []
+    for row_id, old in rows:
+        try:
+            value = convert(old)
+        except ValueError as e:
+            raise ValueError(f"students.id={row_id}: cannot convert face_encoding: {e}") from e
+        if value is not None:
+            updates.append({'row_id': row_id, 'value': value})
+    if updates:
+        conn.execute(
+            students.update()
+            .where(students.c.id == sa.bindparam('row_id'))
+            .values(face_encoding_new=sa.bindparam('value')),
+            updates
+        )
+
+    with op.batch_alter_table('students', schema=None) as batch_op:
+        batch_op.drop_column('face_encoding')
+        batch_op.alter_column('face_encoding_new', new_column_name='face_encoding')
+
+
+def _pack(value):
+    # The column is TEXT on migrated databases (a1b2c3d4e5f6) but JSON on
+    # ones built by create_all(), which psycopg2 already decodes to a list;
+    # only strings still need parsing. JSON null becomes SQL NULL; anything
+    # else that is not an encoding aborts the upgrade rather than dropping
+    # the face silently.
+    encoding = json.loads(value) if isinstance(value, (str, bytes)) else value
+    if encoding is None:
+        return None
+    if not isinstance(encoding, list) or len(encoding) != ENCODING.size // 2:
+        raise ValueError(f"expected a list of {ENCODING.size // 2} numbers")
+    try:
+        return ENCODING.pack(*encoding)
+    except struct.error as e:
+        raise ValueError(str(e)) from e
+
+
+def _unpack(blob):
+    if len(blob) != ENCODING.size:
+        raise ValueError(f"expected {ENCODING.size} bytes, got {len(blob)}")
+    return json.dumps(list(ENCODING.unpack(blob)))
+
+
+def upgrade():
+    # JSON text (~2.5 KB per face, parsed on every search) -> 256 bytes
+    _convert(sa.Text(), sa.LargeBinary(), _pack)
+
+
+def downgrade():
+    _convert(sa.LargeBinary(), sa.Text(), _unpack)
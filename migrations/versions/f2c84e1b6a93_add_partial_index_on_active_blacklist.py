@@ -0,0 +1,43 @@
+"""Add partial index on active blacklist entries
+
+Revision ID: f2c84e1b6a93
+Revises: e5a7c2b90d14
+Create Date: 2026-10-16 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy import inspect
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2c84e1b6a93'
+down_revision = 'e5a7c2b90d14'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    conn = op.get_bind()
+    indexes = {ix['name'] for ix in inspect(conn).get_indexes('blacklist')}
+    if 'ix_blacklist_active_date_added' in indexes:
+        return
+
+    # The blacklist page lists active entries newest first
+    if conn.dialect.name == 'postgresql':
+        # Build without blocking writes to blacklist (see a1b2c3d4e5f6)
+        with op.get_context().autocommit_block():
+            op.create_index(
+                'ix_blacklist_active_date_added', 'blacklist', ['date_added'],
+                postgresql_where=sa.text('is_active'),
+                postgresql_concurrently=True
+            )
+    else:
+        op.create_index(
+            'ix_blacklist_active_date_added', 'blacklist', ['date_added'],
+            sqlite_where=sa.text('is_active = 1')
+        )
+
+
+def downgrade():
+    op.drop_index('ix_blacklist_active_date_added', table_name='blacklist')
@@ -17,13 +17,24 @@ Last Updated: 2026-02-13
 """
 
 from flask_sqlalchemy import SQLAlchemy
+from flask import current_app
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
-import re
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+import string
 import hashlib
+import uuid
+from threading import Lock
 
-from extensions import db
+from cachetools import TTLCache
+from sqlalchemy import event, inspect as sa_inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+
+from extensions import db, cache, cache_ready, get_redis
+from face_handler import FaceHandler
 
 
 # ============================================
@@ -42,6 +53,22 @@ VALID_PROGRAMS = [
     "Visual Arts", "Agriculture", "Home Economics"
 ]
 
+# Student form by years since enrollment (3 or more: completed)
+_FORMS = ("First Form", "Second Form", "Third Form", "Completed")
+
+# Argon2id at the OWASP baseline (46 MiB, t=3, p=1). Hashes made by
+# Werkzeug (PBKDF2/scrypt) still verify and are upgraded on next login.
+_password_hasher = PasswordHasher(time_cost=3, memory_cost=46 * 1024, parallelism=1)
+
+# Low-cost hash for throwaway accounts (CI / test fixtures only)
+FAST_PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+
+# Character classes a password must contain (digits are checked with
+# str.isdecimal, which also accepts non-ASCII digits)
+_PASSWORD_UPPER = frozenset(string.ascii_uppercase)
+_PASSWORD_LOWER = frozenset(string.ascii_lowercase)
+_PASSWORD_SPECIAL = frozenset('!@#$%^&*(),.?":{}|<>')
+
 
 # ============================================
 # 2. AUTH MODELS
@@ -74,15 +101,16 @@ class User(UserMixin, db.Model):
     # Two-Factor Authentication (2FA)
     phone = db.Column(db.String(20))
     two_factor_method = db.Column(db.String(10), default=None)  # email, sms, app, None
-    otp_code = db.Column(db.String(6))  # For email/SMS OTP
+    otp_code = db.Column(db.String(6))  # For email/SMS OTP (only used without Redis)
     otp_expiry = db.Column(db.DateTime)  # OTP expiration time
     totp_secret = db.Column(db.String(32))  # For TOTP (Google Authenticator)
     
-    # Relationships
+    # Relationships (loaded on access; query sites that walk them for many
+    # parents can batch them with selectinload(), which 'dynamic' cannot)
     created_students = db.relationship(
         'Student', 
         backref='creator', 
-        lazy='dynamic', 
+        lazy='select', 
         foreign_keys='Student.created_by'
     )
     
@@ -93,12 +121,20 @@ class User(UserMixin, db.Model):
         cascade='all, delete-orphan'
     )
     
-    def set_password(self, password):
+    # Case-insensitive username (login) and email (password reset)
+    # lookups use these functional indexes
+    __table_args__ = (
+        db.Index('ix_users_username_lower', db.func.lower(username), unique=True),
+        db.Index('ix_users_email_lower', db.func.lower(email)),
+    )
+    
+    def set_password(self, password, method=None):
         """
         Hash and set user password.
         
         Args:
             password (str): Plain text password
+            method (str): Werkzeug hash method override (default: Argon2id)
             
         Raises:
             ValueError: If password doesn't meet complexity requirements
@@ -108,19 +144,38 @@ class User(UserMixin, db.Model):
                 "Password must be 8+ characters with uppercase, lowercase, "
                 "number, and special character."
             )
-        self.password_hash = generate_password_hash(password)
+        if method:
+            self.password_hash = generate_password_hash(password, method=method)
+        else:
+            self.password_hash = _password_hasher.hash(password)
     
     def check_password(self, password):
         """
         Verify password against stored hash.
         
+        A matching legacy Werkzeug hash, or an Argon2 hash made with older
+        parameters, is replaced in place by a current Argon2id hash; the
+        caller commits to persist it.
+        
         Args:
             password (str): Plain text password to verify
             
         Returns:
             bool: True if password matches, False otherwise
         """
-        return check_password_hash(self.password_hash, password)
+        if self.password_hash.startswith('$argon2'):
+            try:
+                _password_hasher.verify(self.password_hash, password)
+            except (VerificationError, InvalidHashError):
+                return False
+            if _password_hasher.check_needs_rehash(self.password_hash):
+                self.password_hash = _password_hasher.hash(password)
+            return True
+        
+        if not check_password_hash(self.password_hash, password):
+            return False
+        self.password_hash = _password_hasher.hash(password)
+        return True
     
     @staticmethod
     def validate_password(password):
@@ -142,15 +197,15 @@ class User(UserMixin, db.Model):
         """
         if len(password) < 8:
             return False
-        if not re.search(r"[A-Z]", password):
-            return False
-        if not re.search(r"[a-z]", password):
-            return False
-        if not re.search(r"\d", password):
-            return False
-        if not re.search(r"[!@#$%^&*(),.?\":{}|<>]", password):
-            return False
-        return True
+        # One pass builds the set of distinct characters; the class checks
+        # are then C-level set intersections instead of four regex scans
+        chars = set(password)
+        return (
+            not chars.isdisjoint(_PASSWORD_UPPER)
+            and not chars.isdisjoint(_PASSWORD_LOWER)
+            and not chars.isdisjoint(_PASSWORD_SPECIAL)
+            and any(ch.isdecimal() for ch in chars)
+        )
     
     @property
     def is_super_admin(self):
@@ -160,6 +215,218 @@ class User(UserMixin, db.Model):
     def __repr__(self):
         return f'<User {self.username}>'
 
+
+# ============================================
+# USER LOOKUP CACHE
+# ============================================
+
+# Seconds a loaded user row may be served from cache
+USER_CACHE_TIMEOUT = 30
+
+# Columns kept in the shared cache. Secrets (password hash, OTP, TOTP
+# secret) and contact details are never cached: they load from the
+# database, in one SELECT, the first time a request touches them.
+_CACHED_USER_COLUMNS = ('username', 'email', 'full_name', 'role', 'is_active',
+                        'two_factor_method')
+
+_USER_ROW = db.select(
+    *(getattr(User, name) for name in _CACHED_USER_COLUMNS)
+).where(User.id == db.bindparam('user_id'))
+
+
+@cache.memoize(timeout=USER_CACHE_TIMEOUT)
+def _load_user_columns(user_id):
+    """Fetch the cacheable columns of a user row (memoized per user ID)."""
+    row = db.session.execute(_USER_ROW, {'user_id': user_id}).one_or_none()
+    return dict(row._mapping) if row is not None else None
+
+
+def get_cached_user(user_id):
+    """
+    Load a user by ID, serving repeated lookups from the shared cache.
+    
+    A user already loaded in the current session is returned as is.
+    Otherwise the instance is built from the cached columns and added to
+    the session as a persistent object without a SELECT; the remaining
+    columns load on first access, and attribute changes are flushed on
+    commit as usual. If the cache could not be initialised the row is
+    loaded from the database.
+    
+    Args:
+        user_id (int|str): User primary key
+        
+    Returns:
+        User: User instance, or None if not found
+    """
+    user_id = int(user_id)
+    user = db.session.identity_map.get(db.session.identity_key(User, user_id))
+    if user is not None:
+        return user
+    
+    if not cache_ready():
+        return db.session.get(User, user_id)
+    
+    columns = _load_user_columns(user_id)
+    if columns is None:
+        return None
+    user = User(id=user_id, **columns)
+    make_transient_to_detached(user)
+    db.session.add(user)
+    return user
+
+
+# Lower-cased username / email -> user ID. IDs never change and
+# every hit is re-checked against the (shared) cached row, so an entry
+# left behind by a rename simply falls through to the database.
+USER_ID_CACHE_TTL = 60
+_user_ids = TTLCache(maxsize=10000, ttl=USER_ID_CACHE_TTL)
+_user_ids_lock = Lock()
+
+# Cache-miss statements are built once at import; each execution only
+# binds the value and hits SQLAlchemy's compiled cache straight away
+_USER_LOOKUPS = {
+    field: db.select(User).where(
+        db.func.lower(getattr(User, field)) == db.bindparam('value')
+    ).limit(1)
+    for field in ('username', 'email')
+}
+
+
+def _find_user(field, value):
+    """
+    Resolve a user through the ID map and row cache, else query by field.
+    
+    Args:
+        field (str): 'username' or 'email'
+        value (str): Lower-cased lookup value
+        
+    Returns:
+        User: User instance, or None if not found
+    """
+    key = (field, value)
+    with _user_ids_lock:
+        user_id = _user_ids.get(key)
+    
+    if user_id is not None:
+        user = get_cached_user(user_id)
+        if user is not None and (getattr(user, field) or '').lower() == value:
+            return user
+    
+    user = db.session.execute(_USER_LOOKUPS[field], {'value': value}).scalar_one_or_none()
+    if user is not None:
+        with _user_ids_lock:
+            _user_ids[key] = user.id
+    return user
+
+
+def get_user_by_username(username):
+    """
+    Look up a user by username (case-insensitive), cached.
+    
+    Args:
+        username (str): Username as typed at login
+        
+    Returns:
+        User: User instance, or None if not found
+    """
+    return _find_user('username', username.lower())
+
+
+def get_user_by_email(email):
+    """
+    Look up a user by email address (case-insensitive), cached.
+    
+    Args:
+        email (str): Email address
+        
+    Returns:
+        User: User instance, or None if not found
+    """
+    return _find_user('email', email.lower())
+
+
+# Internal (X-Internal-Secret) requests act as a super admin; the role
+# only changes through the CLI, so the choice of account is cached
+INTERNAL_USER_CACHE_TIMEOUT = 300
+
+
+_INTERNAL_USER_ID = db.select(User.id).filter_by(role='super_admin').limit(1)
+
+
+@cache.memoize(timeout=INTERNAL_USER_CACHE_TIMEOUT)
+def _internal_user_id():
+    """Fetch the ID of a super admin account (memoized; None is not cached)."""
+    return db.session.execute(_INTERNAL_USER_ID).scalar_one_or_none()
+
+
+def get_internal_user():
+    """
+    Return the super admin that internal service requests act as, cached.
+    
+    The cached ID is re-checked against the (cached) user row, so an
+    account that was deleted or demoted triggers a fresh lookup.
+    
+    Returns:
+        User: Super admin instance, or None if there is none
+    """
+    if not cache_ready():
+        return db.session.execute(
+            db.select(User).filter_by(role='super_admin').limit(1)
+        ).scalar_one_or_none()
+    
+    user_id = _internal_user_id()
+    if user_id is None:
+        return None
+    
+    user = get_cached_user(user_id)
+    if user is None or user.role != 'super_admin':
+        cache.delete_memoized(_internal_user_id)
+        user_id = _internal_user_id()
+        user = get_cached_user(user_id) if user_id is not None else None
+    return user
+
+
+def invalidate_user_cache(user_id):
+    """
+    Drop the cached row for a user after it has been modified.
+    
+    Args:
+        user_id (int|str): User primary key
+    """
+    if not cache_ready():
+        return
+    try:
+        cache.delete_memoized(_load_user_columns, int(user_id))
+    except Exception as e:
+        # Cache backend unavailable; nothing was cached to invalidate
+        current_app.logger.warning(f"User cache invalidation failed: {e}")
+
+
+@event.listens_for(db.session, 'after_flush')
+def _track_user_changes(session, flush_context):
+    """Note users whose cached columns changed; they are invalidated on commit."""
+    changed = {obj.id for obj in session.deleted if isinstance(obj, User)}
+    changed.update(
+        obj.id for obj in session.dirty
+        if isinstance(obj, User) and any(
+            sa_inspect(obj).attrs[name].history.has_changes() for name in _CACHED_USER_COLUMNS
+        )
+    )
+    if changed:
+        session.info.setdefault('users_changed', set()).update(changed)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_users_on_commit(session):
+    for user_id in session.info.pop('users_changed', ()):
+        invalidate_user_cache(user_id)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_user_changes(session):
+    session.info.pop('users_changed', None)
+
+
 class Blacklist(db.Model):
     """Model for tracking blacklisted students"""
     __tablename__ = 'blacklist'
@@ -175,6 +442,17 @@ class Blacklist(db.Model):
     student = db.relationship('Student', backref=db.backref('blacklist_entry', uselist=False, lazy=True))
     added_by_user = db.relationship('User', backref='blacklisted_students')
     
+    # Per-student lookups use the unique student_id index; the blacklist
+    # page lists active entries newest first, which this partial index
+    # serves in order without scanning lifted entries
+    __table_args__ = (
+        db.Index(
+            'ix_blacklist_active_date_added', 'date_added',
+            sqlite_where=db.text('is_active = 1'),
+            postgresql_where=db.text('is_active')
+        ),
+    )
+    
     def __repr__(self):
         return f'<Blacklist {self.student.name if self.student else "Unknown"}>'
     
@@ -259,8 +537,9 @@ class Student(db.Model):
     # Photo (Base64 encoded)
     photo_file = db.Column(db.Text)
     
-    # Face Encoding for Recognition Search
-    face_encoding = db.Column(db.JSON, nullable=True)
+    # Face Encoding for Recognition Search: 128 packed float16 values
+    # (see FaceHandler.pack/unpack)
+    face_encoding = db.Column(db.LargeBinary, nullable=True)
     
     # Metadata
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -271,7 +550,7 @@ class Student(db.Model):
     academic_history = db.relationship(
         'AcademicRecord', 
         backref='student', 
-        lazy='dynamic', 
+        lazy='select', 
         cascade='all, delete-orphan'
     )
     
@@ -290,17 +569,12 @@ class Student(db.Model):
         Returns:
             str: 'First Form', 'Second Form', 'Third Form', or 'Completed'
         """
-        current_year = datetime.now().year
-        diff = current_year - self.enrollment_year
-        
-        if diff >= 3:
-            return "Completed"
-        elif diff == 2:
-            return "Third Form"
-        elif diff == 1:
-            return "Second Form"
-        else:
-            return "First Form"
+        return self._form_in(datetime.now().year)
+    
+    def _form_in(self, current_year):
+        """Form/grade the student is in during current_year."""
+        # Years since enrollment, clamped to 0..3 (future enrollments are First Form)
+        return _FORMS[min(max(current_year - self.enrollment_year, 0), 3)]
     
     @property
     def age(self):
@@ -310,27 +584,29 @@ class Student(db.Model):
         Returns:
             int: Age in years, or None if DOB not set
         """
+        return self._age_on(datetime.now().date())
+    
+    def _age_on(self, today):
+        """Age in whole years on the given date (None if DOB not set)."""
         if self.date_of_birth:
-            today = datetime.now().date()
             return today.year - self.date_of_birth.year - (
                 (today.month, today.day) < (self.date_of_birth.month, self.date_of_birth.day)
             )
         return None
     
-    def to_dict(self):
+    def to_dict(self, today=None):
         """
         Convert student model to dictionary for JSON serialization.
         
+        Args:
+            today (date): Date to compute age and form for; pass it in
+                when serializing many students so the clock is read once
+        
         Returns:
             dict: Student data with calculated fields
         """
-        # Calculate age
-        current_age = None
-        if self.date_of_birth:
+        if today is None:
             today = datetime.now().date()
-            current_age = today.year - self.date_of_birth.year - (
-                (today.month, today.day) < (self.date_of_birth.month, self.date_of_birth.day)
-            )
 
         # Photo URL logic
         photo_url = None
@@ -347,12 +623,12 @@ class Student(db.Model):
             'name': self.name,
             'gender': self.gender,
             'date_of_birth': self.date_of_birth.isoformat() if self.date_of_birth else None,
-            'age': current_age,
+            'age': self._age_on(today),
             'program': self.program,
             'hall': self.hall,
             'class_room': self.class_room,
             'enrollment_year': self.enrollment_year,
-            'current_form': self.current_form,
+            'current_form': self._form_in(today.year),
             'photo_url': photo_url,
             'email': self.email,
             'phone': self.phone,
@@ -379,6 +655,100 @@ class Student(db.Model):
         return f'<Student {self.name}>'
 
 
+# ============================================
+# FACE GALLERY CACHE
+# ============================================
+
+# Every face search compares against all stored encodings. Each process
+# keeps the stacked gallery in memory and only rebuilds it when the
+# version token in the shared cache changes, i.e. after a commit that
+# added, changed or deleted a student's face encoding.
+FACE_GALLERY_VERSION_KEY = 'face_gallery_version'
+
+_FACE_GALLERY = db.select(Student.id, Student.face_encoding).where(
+    Student.face_encoding.isnot(None)
+)
+_face_gallery = {'version': None, 'gallery': None}
+_face_gallery_lock = Lock()
+
+
+def _face_gallery_version():
+    """Read the shared gallery version token (None if the cache is unavailable)."""
+    try:
+        version = cache.get(FACE_GALLERY_VERSION_KEY)
+        if version is None:
+            # add() keeps a token another worker set in the meantime
+            cache.add(FACE_GALLERY_VERSION_KEY, uuid.uuid4().hex, timeout=0)
+            version = cache.get(FACE_GALLERY_VERSION_KEY)
+        return version
+    except Exception as e:
+        current_app.logger.warning(f"Face gallery version lookup failed: {e}")
+        return None
+
+
+def get_face_gallery():
+    """
+    Return the gallery of stored face encodings for FaceHandler.find_match().
+    
+    Without a readable version token (cache down) the gallery is rebuilt
+    on every call, so a search never runs against stale encodings.
+    
+    Returns:
+        tuple: (list of student IDs, (N, 128) float32 array)
+    """
+    version = _face_gallery_version()
+    with _face_gallery_lock:
+        if version is not None and _face_gallery['version'] == version:
+            return _face_gallery['gallery']
+    
+    gallery = FaceHandler.build_gallery(db.session.execute(_FACE_GALLERY).all())
+    with _face_gallery_lock:
+        _face_gallery['version'] = version
+        _face_gallery['gallery'] = gallery
+    return gallery
+
+
+def invalidate_face_gallery():
+    """Make every process rebuild its face gallery on its next search."""
+    try:
+        cache.set(FACE_GALLERY_VERSION_KEY, uuid.uuid4().hex, timeout=0)
+    except Exception as e:
+        current_app.logger.warning(f"Face gallery invalidation failed: {e}")
+    with _face_gallery_lock:
+        _face_gallery['version'] = None
+
+
+@event.listens_for(db.session, 'after_flush')
+def _track_face_changes(session, flush_context):
+    """Note flushes that change the gallery; it is invalidated on commit."""
+    changed = any(isinstance(obj, Student) for obj in session.deleted) or any(
+        isinstance(obj, Student) and obj.face_encoding is not None for obj in session.new
+    ) or any(
+        isinstance(obj, Student) and sa_inspect(obj).attrs.face_encoding.history.has_changes()
+        for obj in session.dirty
+    )
+    if changed:
+        session.info['face_gallery_changed'] = True
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _track_bulk_student_deletes(orm_execute_state):
+    """Bulk Student deletes (query.delete()) bypass the flush."""
+    if orm_execute_state.is_delete and orm_execute_state.bind_mapper is sa_inspect(Student):
+        orm_execute_state.session.info['face_gallery_changed'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def _invalidate_face_gallery_on_commit(session):
+    if session.info.pop('face_gallery_changed', False):
+        invalidate_face_gallery()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_face_changes(session):
+    session.info.pop('face_gallery_changed', None)
+
+
 # ============================================
 # ACADEMIC RECORD MODEL
 # ============================================
@@ -434,9 +804,12 @@ class SecurityLog(db.Model):
     details = db.Column(db.Text)  # Additional event details (JSON or text)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
-    # Indexes for query performance
+    # Indexes for query performance. Per-user timelines filter on user and
+    # event type, newest first; on Postgres the covering column makes that
+    # an index-only scan.
     __table_args__ = (
-        db.Index('ix_security_logs_user_event', 'user_id', 'event_type'),
+        db.Index('ix_security_logs_user_event_ts', 'user_id', 'event_type', 'timestamp',
+                 postgresql_include=['ip_address']),
         db.Index('ix_security_logs_timestamp_event', 'timestamp', 'event_type'),
     )
 
@@ -457,23 +830,35 @@ class UsedPasswordResetToken(db.Model):
     """
     __tablename__ = 'used_password_reset_tokens'
     
-    token_hash = db.Column(db.String(64), primary_key=True)  # SHA256 hash of token
+    token_hash = db.Column(db.LargeBinary(16), primary_key=True)  # BLAKE2b-128 digest of token
     email = db.Column(db.String(120), nullable=False, index=True)
     used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     ip_address = db.Column(db.String(45))
     
+    # Redis claim lifetime: outlives the 1 hour token validity
+    CLAIM_TTL = 3700
+    
+    # Process-local memo of hashes known to be used. Only positives are
+    # cached (a used token never becomes unused), so replaying a spent
+    # link skips the Redis/DB lookup without ever wrongly allowing one.
+    _known_used = TTLCache(maxsize=4096, ttl=CLAIM_TTL)
+    _known_used_lock = Lock()
+    
     @staticmethod
     def hash_token(token):
         """
-        Create SHA256 hash of token for secure storage.
+        Create a 16-byte BLAKE2b digest of token for secure storage.
+        
+        The raw digest keeps the primary key index a quarter of the size
+        of a hex SHA256 string; tokens only ever need to be compared.
         
         Args:
             token (str): Raw token string
             
         Returns:
-            str: Hexadecimal hash string
+            bytes: 16-byte digest
         """
-        return hashlib.sha256(token.encode()).hexdigest()
+        return hashlib.blake2b(token.encode(), digest_size=16).digest()
     
     @classmethod
     def is_token_used(cls, token):
@@ -487,26 +872,96 @@ class UsedPasswordResetToken(db.Model):
             bool: True if token was used, False otherwise
         """
         token_hash = cls.hash_token(token)
-        return cls.query.filter_by(token_hash=token_hash).first() is not None
+        with cls._known_used_lock:
+            if token_hash in cls._known_used:
+                return True
+        
+        client = get_redis()
+        if client is not None:
+            used = client.exists(f"reset:{token_hash.hex()}") > 0
+        else:
+            used = db.session.get(cls, token_hash) is not None
+        
+        if used:
+            cls._remember_used(token_hash)
+        return used
+    
+    @classmethod
+    def _remember_used(cls, token_hash):
+        """Add a token hash to the process-local used-token memo."""
+        with cls._known_used_lock:
+            cls._known_used[token_hash] = True
     
     @classmethod
-    def mark_token_used(cls, token, email, ip_address=None):
+    def try_consume(cls, token, email, ip_address=None):
         """
-        Mark a token as used.
+        Atomically mark a token as used, in one round-trip per store.
+        
+        With Redis, a SET NX EX claim lets only the first caller through.
+        The audit row is then added with INSERT ... ON CONFLICT DO NOTHING
+        RETURNING, which also settles concurrent redemptions when Redis is
+        not configured. The row is part of the current transaction: commit
+        it together with the password change, or roll back and call
+        release_token() if the reset fails.
         
         Args:
-            token (str): Token that was used
+            token (str): Token being redeemed
             email (str): Email address associated with token
             ip_address (str): IP address of user (optional)
+            
+        Returns:
+            bool: True if this caller may use the token
         """
         token_hash = cls.hash_token(token)
-        used_token = cls(
-            token_hash=token_hash,
-            email=email,
-            ip_address=ip_address
-        )
-        db.session.add(used_token)
-        db.session.commit()
+        
+        client = get_redis()
+        if client is not None and not client.set(
+            f"reset:{token_hash.hex()}", 1, nx=True, ex=cls.CLAIM_TTL
+        ):
+            return False
+        
+        values = {
+            'token_hash': token_hash,
+            'email': email,
+            'ip_address': ip_address,
+            'used_at': datetime.utcnow(),
+        }
+        dialect = db.session.get_bind().dialect.name
+        if dialect in ('postgresql', 'sqlite'):
+            if dialect == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert
+            else:
+                from sqlalchemy.dialects.sqlite import insert
+            stmt = (
+                insert(cls).values(**values)
+                .on_conflict_do_nothing(index_elements=['token_hash'])
+                .returning(cls.token_hash)
+            )
+            inserted = db.session.execute(stmt).scalar_one_or_none() is not None
+        else:
+            # No portable upsert: insert in a savepoint and treat a primary
+            # key conflict as "already used"
+            try:
+                with db.session.begin_nested():
+                    db.session.add(cls(**values))
+                inserted = True
+            except IntegrityError:
+                inserted = False
+        return inserted
+    
+    @classmethod
+    def release_token(cls, token):
+        """
+        Release a claim after a failed reset so the link can be retried.
+        
+        The caller rolls back the session to drop the audit row.
+        
+        Args:
+            token (str): Token previously claimed
+        """
+        client = get_redis()
+        if client is not None:
+            client.delete(f"reset:{cls.hash_token(token).hex()}")
 
     def __repr__(self):
         return f'<UsedPasswordResetToken {self.email} at {self.used_at}>'
@@ -0,0 +1,155 @@
+"""
+Rate Limiting Helpers for SchoolSync Pro
+========================================
+Process-local token pre-borrowing on top of the shared Flask-Limiter
+storage, for hot endpoints such as /login, and failure-only counters
+for credential checks.
+
+Author: SchoolSync Team
+Last Updated: 2026-10-16
+"""
+
+from functools import wraps
+from threading import Lock
+
+from cachetools import TTLCache
+from flask import abort
+from flask_limiter.util import get_remote_address
+from limits import parse
+from limits.strategies import FixedWindowRateLimiter
+
+from extensions import limiter
+
+
+# ============================================
+# TOKEN PRE-BORROWING
+# ============================================
+
+def _charge(item, namespace, key, cost):
+    """
+    Charge up to cost hits to the shared limit in one storage call.
+
+    The fixed-window counter is incremented even when a hit is refused,
+    so rather than asking for all-or-nothing, a batch that only partly
+    fits is granted the hits that were still left in the window.
+    Other strategies refuse without recording anything; a batch they
+    refuse is retried as a single hit.
+
+    Returns:
+        int: Hits granted (0 if the limit is exhausted)
+    """
+    strategy = limiter.limiter
+    if isinstance(strategy, FixedWindowRateLimiter):
+        count = strategy.storage.incr(item.key_for(namespace, key), item.get_expiry(),
+                                      amount=cost)
+        return max(0, min(cost, item.amount - (count - cost)))
+    if strategy.hit(item, namespace, key, cost=cost):
+        return cost
+    if cost > 1 and strategy.hit(item, namespace, key):
+        return 1
+    return 0
+
+
+def preborrowed_limit(limit_string, key_func=get_remote_address,
+                      borrow_fraction=0.25, burst_seconds=1):
+    """
+    Rate-limit a view while calling limiter storage once per batch of hits.
+
+    A request that has no local tokens charges a single hit to the shared
+    storage, so occasional requests cost exactly what @limiter.limit
+    would. Only when the same key comes back within burst_seconds does the
+    worker borrow a batch (borrow_fraction of the limit) in one storage
+    call; it spends one hit of the batch and keeps the rest for the length
+    of the limit window, so borrowed hits are never thrown away unused.
+
+    Every request served has been charged to the shared counter first, so
+    workers cannot exceed the limit collectively within a window. A batch
+    can be spent just after the window it was charged to rolls over; that
+    is the same boundary slack fixed-window limiting already allows.
+
+    Use together with @limiter.exempt so the default limits do not add
+    their own storage calls to the same view.
+
+    Args:
+        limit_string (str): Limit in Flask-Limiter notation (e.g. "10 per minute")
+        key_func (callable): Returns the rate-limit key for the request
+        borrow_fraction (float): Share of the limit borrowed per storage call
+        burst_seconds (int): Gap between requests that counts as a burst
+
+    Returns:
+        callable: View decorator
+    """
+    item = parse(limit_string)
+    batch = max(1, int(item.amount * borrow_fraction))
+
+    def decorator(view):
+        namespace = f"preborrow:{view.__module__}.{view.__name__}"
+        # key -> [remaining tokens]; a list so decrements keep the original TTL
+        buckets = TTLCache(maxsize=16384, ttl=item.get_expiry())
+        # Keys seen within burst_seconds; the next hit from them borrows
+        recent = TTLCache(maxsize=16384, ttl=burst_seconds)
+        lock = Lock()
+
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if not limiter.enabled:
+                return view(*args, **kwargs)
+
+            key = key_func()
+
+            with lock:
+                bucket = buckets.get(key)
+                spent_locally = bucket is not None and bucket[0] > 0
+                if spent_locally:
+                    bucket[0] -= 1
+                bursting = key in recent
+                recent[key] = True
+
+            if not spent_locally:
+                granted = _charge(item, namespace, key, batch if bursting else 1)
+                if granted == 0:
+                    # Not even a single hit left in this window
+                    abort(429)
+                if granted > 1:
+                    with lock:
+                        buckets[key] = [granted - 1]
+
+            return view(*args, **kwargs)
+
+        return wrapped
+
+    return decorator
+
+
+# ============================================
+# FAILURE COUNTERS
+# ============================================
+
+class FailureLimit:
+    """
+    Limit that only counts failed attempts, kept in limiter storage.
+    
+    Unlike @limiter.limit, successful requests cost nothing; callers
+    check exceeded() up front and call hit() when an attempt fails.
+    With Redis storage each hit is one fixed-window INCR, shared by all
+    workers and not resettable by clearing cookies.
+    
+    Args:
+        limit_string (str): Limit in Flask-Limiter notation (e.g. "5 per 15 minutes")
+        namespace (str): Storage key prefix for this counter
+    """
+    
+    def __init__(self, limit_string, namespace):
+        self.item = parse(limit_string)
+        self.namespace = namespace
+    
+    def exceeded(self, key):
+        """Return True if key has no failed attempts left in this window."""
+        if not limiter.enabled:
+            return False
+        return not limiter.limiter.test(self.item, self.namespace, key)
+    
+    def hit(self, key):
+        """Record one failed attempt for key."""
+        if limiter.enabled:
+            limiter.limiter.hit(self.item, self.namespace, key)
@@ -23,11 +23,12 @@ from flask import (
     Blueprint, render_template, request, jsonify, send_file, 
     redirect, url_for, flash, current_app
 )
-from extensions import db
+from extensions import db, cached_view
 from models import (
     Student, AcademicRecord, User, Blacklist, 
     Program, Hall, # New dynamic models
-    VALID_HALLS, VALID_PROGRAMS # Fallbacks
+    VALID_HALLS, VALID_PROGRAMS, # Fallbacks
+    invalidate_user_cache, get_face_gallery
 )
 from datetime import datetime
 from sqlalchemy import or_, and_, func
@@ -64,11 +65,14 @@ main = Blueprint('main', __name__)
 
 @main.route('/api/stats', methods=['GET'])
 @login_required
+@cached_view(timeout=60, per_user=False)  # Same figures for every user
 def get_stats():
     """
     Get dashboard statistics.
     
     Returns student counts by form level using optimized SQL aggregation.
+    Responses are cached for up to a minute, so the dashboard may lag
+    behind the latest imports by that much.
     
     Returns:
         JSON: {
@@ -268,6 +272,7 @@ def settings():
         temp_secret = pyotp.random_base32()
         current_user.totp_secret = temp_secret
         db.session.commit()
+        invalidate_user_cache(current_user.id)
         
         uri, _ = get_totp_uri(current_user)
         qr_code = generate_qr_code(uri)
@@ -286,7 +291,10 @@ from datetime import datetime
 @login_required
 def blacklist_page():
     """Display blacklist management page"""
-    blacklisted = Blacklist.query.filter_by(is_active=True).order_by(Blacklist.date_added.desc()).all()
+    # The table shows each entry's student and who added it; load both up front
+    blacklisted = Blacklist.query.options(
+        db.joinedload(Blacklist.student), db.joinedload(Blacklist.added_by_user)
+    ).filter_by(is_active=True).order_by(Blacklist.date_added.desc()).all()
     return render_template('blacklist.html', blacklisted=blacklisted)
 
 @main.route('/face-search')
@@ -310,15 +318,9 @@ def api_face_search():
             # Return 200 so UI can handle it gracefully without a red error toast
             return jsonify({'success': True, 'match': False, 'message': 'No face detected in image'}), 200
             
-        students = Student.query.filter(Student.face_encoding.isnot(None)).all()
-        known_encodings = [
-            {'id': s.id, 'encoding': s.face_encoding} 
-            for s in students if s.face_encoding
-        ]
-        
-        result = FaceHandler.find_match(known_encodings, target_encoding)
-        if result['match']:
-            student = Student.query.get(result['id'])
+        result = FaceHandler.find_match(get_face_gallery(), target_encoding)
+        student = db.session.get(Student, result['id']) if result['match'] else None
+        if student is not None:
             return jsonify({
                 'success': True,
                 'match': True,
@@ -353,7 +355,7 @@ def add_to_blacklist():
             return jsonify({'success': False, 'message': 'Reason is required'}), 400
         
         # Check if student exists
-        student = Student.query.get(student_id)
+        student = db.session.get(Student, student_id)
         if not student:
             return jsonify({'success': False, 'message': 'Student not found'}), 404
         
@@ -406,7 +408,7 @@ def bulk_blacklist():
         count = 0
         for sid in student_ids:
             # Check if student exists
-            student = Student.query.get(sid)
+            student = db.session.get(Student, sid)
             if not student:
                 continue
                 
@@ -429,7 +431,7 @@ def bulk_blacklist():
         
         # Trigger n8n automation for each blacklisted student
         for sid in student_ids:
-            s = Student.query.get(sid)
+            s = db.session.get(Student, sid)
             if s:
                 send_to_n8n('student_blacklisted', {
                     'student_id': s.id,
@@ -452,7 +454,7 @@ def bulk_blacklist():
 def remove_from_blacklist(blacklist_id):
     """Remove a student from the blacklist"""
     try:
-        blacklist_entry = Blacklist.query.get(blacklist_id)
+        blacklist_entry = db.session.get(Blacklist, blacklist_id)
         
         if not blacklist_entry:
             return jsonify({'success': False, 'message': 'Blacklist entry not found'}), 404
@@ -483,7 +485,7 @@ def update_blacklist_reason(blacklist_id):
         if not new_reason:
             return jsonify({'success': False, 'message': 'Reason is required'}), 400
         
-        blacklist_entry = Blacklist.query.get(blacklist_id)
+        blacklist_entry = db.session.get(Blacklist, blacklist_id)
         
         if not blacklist_entry:
             return jsonify({'success': False, 'message': 'Blacklist entry not found'}), 404
@@ -521,23 +523,19 @@ def search_students():
     if len(query) < 2:
         return jsonify([]), 200
     
-    students = Student.query.filter(
+    # Blacklist entries for all matches come back in one IN query
+    students = Student.query.options(db.selectinload(Student.blacklist_entry)).filter(
         Student.name.ilike(f'%{query}%')
     ).limit(10).all()
     
     results = []
     for student in students:
-        # Check if blacklisted
-        is_blacklisted = Blacklist.query.filter_by(
-            student_id=student.id, 
-            is_active=True
-        ).first() is not None
-        
+        entry = student.blacklist_entry
         results.append({
             'id': student.id,
             'name': student.name,
             'program': student.program,
-            'is_blacklisted': is_blacklisted
+            'is_blacklisted': entry is not None and entry.is_active
         })
     
     return jsonify(results), 200
@@ -575,8 +573,9 @@ def get_students():
         # Get and sanitize search query
         search = sanitize_search_query(request.args.get('search', '').strip())
         
-        # Start with base query
-        query = Student.query
+        # Start with base query; to_dict() reads each student's blacklist
+        # entry, so fetch them for the whole page in one IN query
+        query = Student.query.options(db.selectinload(Student.blacklist_entry))
         
         # Apply search filter (if provided)
         if search:
@@ -610,9 +609,10 @@ def get_students():
         # Paginate results
         pagination = query.paginate(page=page, per_page=per_page, error_out=False)
         
+        today = datetime.now().date()
         return jsonify({
             'success': True,
-            'students': [s.to_dict() for s in pagination.items],
+            'students': [s.to_dict(today) for s in pagination.items],
             'total': pagination.total,
             'pages': pagination.pages
         })
@@ -728,7 +728,7 @@ def create_student():
         
         face_encoding = None
         if photo_url:
-            face_encoding = FaceHandler.get_encoding(photo_url)
+            face_encoding = FaceHandler.pack(FaceHandler.get_encoding(photo_url))
 
         # Create new student record
         new_student = Student(
@@ -813,7 +813,7 @@ def update_student(id):
                     if photo_url:
                         encoding = FaceHandler.get_encoding(photo_url)
                         if encoding:
-                            student.face_encoding = encoding
+                            student.face_encoding = FaceHandler.pack(encoding)
                             
                 except Exception as e:
                     return jsonify({'error': str(e)}), 400
@@ -1122,26 +1122,16 @@ def bulk_encode():
             return jsonify({'error': 'No students selected'}), 400
             
         students = Student.query.filter(Student.id.in_(ids)).all()
-        success_count = 0
-        skip_count = 0
-        error_count = 0
-        
-        for student in students:
-            if not student.photo_file:
-                skip_count += 1
-                continue
-                
-            try:
-                # If it's a base64 or URL, FaceHandler can handle it or if it's local
-                encoding = FaceHandler.get_encoding(student.photo_file)
-                if encoding:
-                    student.face_encoding = encoding
-                    success_count += 1
-                else:
-                    error_count += 1
-            except Exception as e:
-                current_app.logger.error(f"Failed to encode face for student {student.id}: {e}")
-                error_count += 1
+        with_photo = [student for student in students if student.photo_file]
+        skip_count = len(students) - len(with_photo)
+        
+        # Data URIs and local files are decoded and encoded in batches
+        encodings = FaceHandler.get_encoding_batch([student.photo_file for student in with_photo])
+        for student, encoding in zip(with_photo, encodings):
+            if encoding:
+                student.face_encoding = FaceHandler.pack(encoding)
+        success_count = sum(1 for encoding in encodings if encoding)
+        error_count = len(with_photo) - success_count
                 
         db.session.commit()
         
@@ -1163,7 +1153,9 @@ def bulk_encode():
         
     except Exception as e:
         db.session.rollback()
-        return jsonify({'success': False, 'message': str(e)}), 500@main.route('/api/students/bulk-email', methods=['POST'])
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+@main.route('/api/students/bulk-email', methods=['POST'])
 @login_required
 def bulk_email():
     """Send emails to multiple students"""
@@ -1183,23 +1175,19 @@ def bulk_email():
             return jsonify({'error': 'None of the selected students have email addresses'}), 400
             
         # Send emails asynchronously
-        from utils import send_async_email
-        from flask_mail import Message
-        
-        app = current_app._get_current_object()
+        from utils import queue_delivery, deliver_email, build_message
         
         # In a real app, we might want to send one email with BCC or individual emails
         # For this system, individual emails might be better for personalization later
         # But for now, let's send them in a loop or a single message with BCC
         
-        msg = Message(
+        msg = build_message(
             subject,
             bcc=emails, # Use BCC for privacy
             body=f"{message_text}\n\n---\nSent via SchoolSync Pro"
         )
         
-        thread = Thread(target=send_async_email, args=[app, msg])
-        thread.start()
+        queue_delivery(deliver_email, msg)
         
         log_bulk_operation(
             user_id=current_user.id,
@@ -1444,7 +1432,7 @@ def update_profile():
     Update user profile information.
     
     Validates email and phone number formats.
-    Prevents duplicate usernames.
+    Prevents duplicate usernames and email addresses.
     
     Returns:
         Redirect to settings page with flash message
@@ -1452,23 +1440,41 @@ def update_profile():
     try:
         changed_fields = []
         
-        # Check for username change
         new_username = request.form.get('username', '').strip()
-        if new_username != current_user.username:
-            # Check if username is taken
-            existing = User.query.filter_by(username=new_username).first()
-            if existing:
+        new_email = request.form.get('email', '').strip()
+        username_changed = new_username != current_user.username
+        # Emails are matched case-insensitively; the address is stored as typed
+        email_changed = new_email.lower() != (current_user.email or '').lower()
+        
+        if email_changed and not validate_email(new_email):
+            flash('Invalid email address format', 'error')
+            return redirect(url_for('main.settings'))
+        
+        # Check username and email uniqueness in one query
+        # (both are unique case-insensitively)
+        conditions = []
+        if username_changed:
+            conditions.append(func.lower(User.username) == new_username.lower())
+        if email_changed:
+            conditions.append(func.lower(User.email) == new_email.lower())
+        
+        if conditions:
+            taken = db.session.query(User.username, User.email).filter(
+                or_(*conditions),
+                User.id != current_user.id
+            ).all()
+            if username_changed and any(row.username.lower() == new_username.lower() for row in taken):
                 flash('Username is already taken', 'error')
                 return redirect(url_for('main.settings'))
+            if email_changed and any(row.email.lower() == new_email.lower() for row in taken):
+                flash('Email address is already in use', 'error')
+                return redirect(url_for('main.settings'))
+        
+        if username_changed:
             current_user.username = new_username
             changed_fields.append('username')
         
-        # Validate and update email
-        new_email = request.form.get('email', '').strip()
-        if new_email != current_user.email:
-            if not validate_email(new_email):
-                flash('Invalid email address format', 'error')
-                return redirect(url_for('main.settings'))
+        if email_changed:
             current_user.email = new_email
             changed_fields.append('email')
         
@@ -1488,6 +1494,7 @@ def update_profile():
             changed_fields.append('full_name')
         
         db.session.commit()
+        invalidate_user_cache(current_user.id)
         
         # Log profile update
         if changed_fields:
@@ -1542,6 +1549,7 @@ def update_2fa():
             current_user.totp_secret = None
         
         db.session.commit()
+        invalidate_user_cache(current_user.id)
         
         # Log 2FA change
         enabled = method != 'off'
@@ -7,12 +7,15 @@ Author: SchoolSync Team
 Last Updated: 2026-01-16
 """
 
-from flask_mail import Message
 from flask import current_app, url_for
 import random
 import string
 import sys
-from threading import Thread
+import time
+import queue
+import atexit
+from datetime import datetime
+from threading import Thread, Lock, Timer, Event
 import io
 import base64
 from itsdangerous import URLSafeTimedSerializer
@@ -38,21 +41,36 @@ def generate_otp():
 # EMAIL FUNCTIONS
 # ============================================
 
-def send_async_email(app, msg):
+def build_message(subject, **kwargs):
     """
-    Send email asynchronously in background thread.
+    Create a Flask-Mail Message, binding Flask-Mail to the app first.
+    
+    Message() reads the default sender from the bound extension, so the
+    lazy get_mail() has to run before it.
+    
+    Args:
+        subject (str): Email subject line
+        **kwargs: Passed through to flask_mail.Message
+        
+    Returns:
+        Message: Unsent message
+    """
+    from extensions import get_mail
+    from flask_mail import Message
+    get_mail()
+    return Message(subject, **kwargs)
+
+
+def deliver_email(msg):
+    """
+    Send an email now (runs on the delivery thread; raises on failure).
     
     Args:
-        app: Flask application instance
         msg: Flask-Mail Message object
     """
-    with app.app_context():
-        try:
-            from extensions import mail
-            mail.send(msg)
-            print("✅ Email sent successfully", file=sys.stdout)
-        except Exception as e:
-            print(f"❌ Email failed: {str(e)}", file=sys.stderr)
+    from extensions import get_mail
+    get_mail().send(msg)
+    print("✅ Email sent successfully", file=sys.stdout)
 
 
 def send_email_otp(email, otp):
@@ -67,7 +85,7 @@ def send_email_otp(email, otp):
         bool: True (always, to not break flow even if email fails)
     """
     try:
-        msg = Message(
+        msg = build_message(
             'SchoolSync Login Verification',
             recipients=[email]
         )
@@ -83,9 +101,7 @@ If you did not request this code, please ignore this email.
 SchoolSync Pro - Student Management System
 '''
         
-        app = current_app._get_current_object()
-        thread = Thread(target=send_async_email, args=[app, msg])
-        thread.start()
+        queue_delivery(deliver_email, msg)
         
         print(f"📧 Sending OTP to {email}...", file=sys.stdout)
         return True
@@ -109,14 +125,14 @@ def send_password_reset_email(email):
     """
     try:
         # Generate secure token
-        serializer = URLSafeTimedSerializer(current_app.config['SECRET_KEY'])
-        token = serializer.dumps(email, salt='password-reset-salt')
+        serializer = current_app.extensions['reset_serializer']
+        token = serializer.dumps(email)
         
         # Create password reset link
         link = url_for('auth.reset_password', token=token, _external=True)
         
         # Create email message
-        msg = Message(
+        msg = build_message(
             'Reset Your Password - SchoolSync Pro',
             recipients=[email]
         )
@@ -137,9 +153,7 @@ SchoolSync Pro - Student Management System
 '''
         
         # Send asynchronously
-        app = current_app._get_current_object()
-        thread = Thread(target=send_async_email, args=[app, msg])
-        thread.start()
+        queue_delivery(deliver_email, msg)
         
         print(f"📧 Sending password reset to {email}...", file=sys.stdout)
         print(f"🔐 [DEBUG] Reset link: {link}", file=sys.stdout)
@@ -159,7 +173,9 @@ def send_sms_otp(phone, otp):
     """
     Send OTP verification code via SMS (Twilio).
     
-    Falls back to mock/logging if Twilio is not configured.
+    The Twilio API call runs on the background delivery thread so the
+    request does not wait on it. Falls back to mock/logging if Twilio
+    is not configured.
     
     Args:
         phone (str): Recipient phone number
@@ -169,36 +185,128 @@ def send_sms_otp(phone, otp):
         bool: True (always, to not break flow)
     """
     try:
-        account_sid = current_app.config.get('TWILIO_ACCOUNT_SID')
-        auth_token = current_app.config.get('TWILIO_AUTH_TOKEN')
-        from_number = current_app.config.get('TWILIO_PHONE_NUMBER')
-
-        # Check if Twilio is configured
-        if not account_sid or not auth_token or not from_number:
-            print(
-                f"📱 [MOCK SMS] To: {phone} | Code: {otp}",
-                file=sys.stdout
-            )
-            return True
-
-        # Send real SMS via Twilio
-        from twilio.rest import Client
-        
-        client = Client(account_sid, auth_token)
-        message = client.messages.create(
-            body=f"Your SchoolSync verification code is: {otp}\n\nExpires in 10 minutes.",
-            from_=from_number,
-            to=phone
-        )
-        
-        print(f"📱 SMS sent to {phone} (SID: {message.sid})", file=sys.stdout)
+        queue_delivery(deliver_sms, phone, otp)
         return True
         
     except Exception as e:
-        print(f"❌ SMS failed: {e}", file=sys.stderr)
+        print(f"❌ Error starting SMS task: {e}", file=sys.stderr)
         return True  # Don't break login flow
 
 
+def deliver_sms(phone, otp):
+    """
+    Send an OTP SMS now (runs on the delivery thread; raises on failure).
+    
+    Args:
+        phone (str): Recipient phone number
+        otp (str): 6-digit OTP code
+    """
+    account_sid = current_app.config.get('TWILIO_ACCOUNT_SID')
+    auth_token = current_app.config.get('TWILIO_AUTH_TOKEN')
+    from_number = current_app.config.get('TWILIO_PHONE_NUMBER')
+
+    # Check if Twilio is configured
+    if not account_sid or not auth_token or not from_number:
+        print(
+            f"📱 [MOCK SMS] To: {phone} | Code: {otp}",
+            file=sys.stdout
+        )
+        return
+
+    # Send real SMS via Twilio
+    from twilio.rest import Client
+    
+    client = Client(account_sid, auth_token)
+    message = client.messages.create(
+        body=f"Your SchoolSync verification code is: {otp}\n\nExpires in 10 minutes.",
+        from_=from_number,
+        to=phone
+    )
+    
+    print(f"📱 SMS sent to {phone} (SID: {message.sid})", file=sys.stdout)
+
+
+# ============================================
+# DELIVERY QUEUE
+# ============================================
+
+# Attempts per email/SMS before it is given up
+DELIVERY_MAX_ATTEMPTS = 3
+
+_delivery_queue = queue.Queue(maxsize=1000)
+_delivery_worker = None
+_delivery_lock = Lock()
+
+
+def queue_delivery(task, *args):
+    """
+    Hand an email/SMS send to the background delivery thread.
+    
+    One long-lived thread per process works through the queue (instead
+    of a new thread per message) and retries failed sends with backoff.
+    
+    Args:
+        task (callable): Send function, e.g. deliver_email; raises on failure
+        *args: Arguments for task
+    """
+    global _delivery_worker
+    app = current_app._get_current_object()
+    
+    with _delivery_lock:
+        if _delivery_worker is None or not _delivery_worker.is_alive():
+            _delivery_worker = Thread(
+                target=_run_deliveries, args=[app], daemon=True
+            )
+            _delivery_worker.start()
+    
+    try:
+        _delivery_queue.put_nowait((task, args, 1))
+    except queue.Full:
+        # Worker is falling behind; send this one on its own thread
+        Thread(target=_deliver, args=[app, task, args, 1], daemon=True).start()
+
+
+def _run_deliveries(app):
+    """
+    Background loop: send queued emails/SMS one at a time.
+    
+    Args:
+        app: Flask application instance
+    """
+    while True:
+        task, args, attempt = _delivery_queue.get()
+        _deliver(app, task, args, attempt)
+
+
+def _deliver(app, task, args, attempt):
+    """
+    Run one send inside an app context.
+    
+    A failed send is put back on the queue after a backoff (2s, 4s) by a
+    timer, so one failing message never holds up the ones behind it.
+    
+    Args:
+        app: Flask application instance
+        task (callable): Send function
+        args (tuple): Arguments for task
+        attempt (int): 1-based attempt number
+    """
+    try:
+        with app.app_context():
+            task(*args)
+    except Exception as e:
+        print(
+            f"❌ {task.__name__} failed (attempt {attempt}/{DELIVERY_MAX_ATTEMPTS}): {e}",
+            file=sys.stderr
+        )
+        if attempt < DELIVERY_MAX_ATTEMPTS:
+            retry = Timer(
+                2 ** attempt, _delivery_queue.put, args=[(task, args, attempt + 1)]
+            )
+            retry.daemon = True
+            retry.start()
+
+
 # ============================================
 # TOTP (GOOGLE AUTHENTICATOR) FUNCTIONS
 # ============================================
@@ -310,10 +418,239 @@ def verify_totp(user, code):
         return False
 
 
+# ============================================
+# BACKGROUND WRITES
+# ============================================
+
+# Seconds the writer thread waits to coalesce last_login updates
+LAST_LOGIN_FLUSH_INTERVAL = 2
+
+# Redis hash of user ID -> ISO login time, shared by all workers
+LAST_LOGIN_PENDING_KEY = 'schoolsync:last_login_pending'
+
+_last_login_queue = queue.Queue(maxsize=10000)
+_last_login_worker = None
+_last_login_lock = Lock()
+_last_login_stop = Event()
+
+
+def start_last_login_writer(app):
+    """
+    Start this process's last_login writer thread if it is not running.
+    
+    With Redis the thread drains the shared hash of pending logins, so it
+    is started when each gunicorn worker boots (see post_worker_init)
+    rather than on its first login: logins buffered by a worker that has
+    since been recycled are written even if no other worker logs anyone
+    in. Pending updates are written out at interpreter exit.
+    
+    Args:
+        app: Flask application instance
+    """
+    from extensions import get_redis
+    global _last_login_worker
+    
+    with _last_login_lock:
+        if _last_login_worker is not None and _last_login_worker.is_alive():
+            return
+        with app.app_context():
+            client = get_redis()
+        first_start = _last_login_worker is None
+        target = _drain_last_logins if client is not None else _flush_last_logins
+        _last_login_stop.clear()
+        _last_login_worker = Thread(target=target, args=[app], daemon=True)
+        _last_login_worker.start()
+        if first_start:
+            atexit.register(stop_last_login_writer)
+
+
+def stop_last_login_writer(timeout=5):
+    """
+    Write out pending last_login updates and stop the writer thread.
+    
+    Called from gunicorn's worker_exit hook and at interpreter exit;
+    safe to call more than once.
+    
+    Args:
+        timeout (float): Seconds to wait for the final write
+    """
+    worker = _last_login_worker
+    if worker is None or not worker.is_alive():
+        return
+    _last_login_stop.set()
+    try:
+        # Wakes the queue writer; the Redis drainer watches the event
+        _last_login_queue.put(None, timeout=1)
+    except queue.Full:
+        pass
+    worker.join(timeout)
+
+
+def record_last_login(user_id, when=None):
+    """
+    Queue a last_login update instead of committing it on the request path.
+    
+    Updates are coalesced per user by a background thread and written
+    in batches with a single UPDATE statement. With Redis the pending
+    updates live in a shared hash, so whichever worker flushes next
+    writes them (nothing is lost if this instance is frozen or recycled);
+    otherwise they wait in a process-local queue.
+    
+    Args:
+        user_id (int): ID of user who logged in
+        when (datetime): Login time (defaults to now, UTC)
+    """
+    from extensions import get_redis
+    when = when or datetime.utcnow()
+    client = get_redis()
+    
+    start_last_login_writer(current_app._get_current_object())
+    
+    if client is not None:
+        client.hset(LAST_LOGIN_PENDING_KEY, user_id, when.isoformat())
+        return
+    
+    try:
+        _last_login_queue.put_nowait((user_id, when))
+    except queue.Full:
+        # Writer is falling behind; write this one directly
+        write_last_logins({user_id: when})
+
+
+def _flush_last_logins(app):
+    """
+    Background loop: collect queued logins for one interval, then write them.
+    
+    A None in the queue (see stop_last_login_writer) writes what has
+    been collected and ends the loop.
+    
+    Args:
+        app: Flask application instance
+    """
+    stopping = False
+    while not stopping:
+        item = _last_login_queue.get()
+        if item is None:
+            return
+        user_id, when = item
+        pending = {user_id: when}
+        deadline = time.monotonic() + LAST_LOGIN_FLUSH_INTERVAL
+        
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _last_login_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                stopping = True
+                break
+            user_id, when = item
+            pending[user_id] = when
+        
+        with app.app_context():
+            write_last_logins(pending)
+
+
+def _drain_last_logins(app):
+    """
+    Background loop: every interval, take the shared Redis hash and write it.
+    
+    Runs one last pass when stop_last_login_writer() is called.
+    
+    Args:
+        app: Flask application instance
+    """
+    while not _last_login_stop.wait(LAST_LOGIN_FLUSH_INTERVAL):
+        _take_pending_logins(app)
+    _take_pending_logins(app)
+
+
+def _take_pending_logins(app):
+    """
+    Take the shared Redis hash of pending logins and write it.
+    
+    HGETALL and DEL run in one MULTI/EXEC, so each pending login is
+    taken by exactly one worker.
+    
+    Args:
+        app: Flask application instance
+    """
+    from extensions import get_redis
+    
+    with app.app_context():
+        try:
+            pipe = get_redis().pipeline()
+            pipe.hgetall(LAST_LOGIN_PENDING_KEY)
+            pipe.delete(LAST_LOGIN_PENDING_KEY)
+            raw, _ = pipe.execute()
+        except Exception as e:
+            print(f"❌ last_login drain failed: {e}", file=sys.stderr)
+            return
+        
+        if raw:
+            pending = {}
+            for user_id, when in raw.items():
+                pending[int(user_id)] = datetime.fromisoformat(when.decode())
+            write_last_logins(pending)
+
+
+def write_last_logins(pending):
+    """
+    Write a batch of last_login timestamps in one UPDATE ... CASE statement.
+    
+    Args:
+        pending (dict): Mapping of user ID to login datetime
+        
+    Returns:
+        bool: True if written, False on error
+    """
+    from extensions import db
+    from models import User
+    from sqlalchemy import update, case
+    
+    try:
+        db.session.execute(
+            update(User)
+            .where(User.id.in_(list(pending)))
+            .values(last_login=case(pending, value=User.id))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        return True
+    except Exception as e:
+        db.session.rollback()
+        print(f"❌ last_login update failed: {e}", file=sys.stderr)
+        return False
+
+
 # ============================================
 # TOKEN GENERATION HELPERS
 # ============================================
 
+def _get_serializer(salt):
+    """
+    Return the app's token serializer for salt, creating it once.
+    
+    Serializers are cached per salt in app.extensions (like the password
+    reset serializer) instead of being rebuilt on every call.
+    
+    Args:
+        salt (str): Salt for token signing
+        
+    Returns:
+        URLSafeTimedSerializer: Serializer bound to SECRET_KEY and salt
+    """
+    serializers = current_app.extensions.setdefault('token_serializers', {})
+    serializer = serializers.get(salt)
+    if serializer is None:
+        serializer = URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt=salt)
+        serializers[salt] = serializer
+    return serializer
+
+
 def generate_secure_token(data, salt='default-salt', max_age=3600):
     """
     Generate secure signed token with expiration.
@@ -326,8 +663,7 @@ def generate_secure_token(data, salt='default-salt', max_age=3600):
     Returns:
         str: Signed token
     """
-    serializer = URLSafeTimedSerializer(current_app.config['SECRET_KEY'])
-    return serializer.dumps(data, salt=salt)
+    return _get_serializer(salt).dumps(data)
 
 
 def verify_secure_token(token, salt='default-salt', max_age=3600):
@@ -343,8 +679,7 @@ def verify_secure_token(token, salt='default-salt', max_age=3600):
         tuple: (success: bool, data or error_message)
     """
     try:
-        serializer = URLSafeTimedSerializer(current_app.config['SECRET_KEY'])
-        data = serializer.loads(token, salt=salt, max_age=max_age)
+        data = _get_serializer(salt).loads(token, max_age=max_age)
         return True, data
     except Exception as e:
         return False, str(e)
@@ -13,6 +13,12 @@ from werkzeug.utils import secure_filename
 import io
 
 
+# Compiled once at import; validators run on every form submission
+_EMAIL_RE = re.compile(r'\A[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}\Z')
+_PHONE_SEPARATORS_RE = re.compile(r'[\s\-\(\)]')
+_PHONE_RE = re.compile(r'\A(0\d{9}|233\d{9}|\+233\d{9})\Z')
+_USERNAME_RE = re.compile(r'\A[a-zA-Z0-9_-]+\Z')
+
 
 # ============================================
 # EMAIL VALIDATION
@@ -31,8 +37,7 @@ def validate_email(email):
     if not email or len(email) > 120:
         return False
     
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    return _EMAIL_RE.match(email) is not None
 
 
 # ============================================
@@ -58,10 +63,10 @@ def validate_phone(phone):
         return True  # Optional field
     
     # Remove spaces, dashes, and parentheses
-    clean = re.sub(r'[\s\-\(\)]', '', phone)
+    clean = _PHONE_SEPARATORS_RE.sub('', phone)
     
     # Ghana number patterns
-    return re.match(r'^(0\d{9}|233\d{9}|\+233\d{9})$', clean) is not None
+    return _PHONE_RE.match(clean) is not None
 
 
 def normalize_phone(phone):
@@ -77,7 +82,7 @@ def normalize_phone(phone):
     if not phone:
         return phone
     
-    clean = re.sub(r'[\s\-\(\)]', '', phone)
+    clean = _PHONE_SEPARATORS_RE.sub('', phone)
     
     # Convert to international format if local
     if clean.startswith('0') and len(clean) == 10:
@@ -346,7 +351,7 @@ def validate_username(username):
         return False, "Username must start with a letter or number"
     
     # Only alphanumeric, underscore, dash
-    if not re.match(r'^[a-zA-Z0-9_-]+$', username):
+    if not _USERNAME_RE.match(username):
         return False, "Username can only contain letters, numbers, underscore, and dash"
     
     return True, None